@@ -0,0 +1 @@
+../convert/columnar_lib.py
\ No newline at end of file
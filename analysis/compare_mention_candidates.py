@@ -2,46 +2,95 @@ import collections
 import json
 import sys
 
+import numpy as np
+
+import parallel_lib
+
+MAX_SPAN_WIDTH = 30
+COUNT_FIELDS = ["gold", "tp", "fp", "fn", "e2e_spans", "width_bounded_spans"]
+CHUNK_SIZE = 64 # Documents per worker task
+
+
+def width_bounded_span_count(sentence_lens, max_width=MAX_SPAN_WIDTH):
+  """Spans of fewer than max_width + 1 tokens inside each sentence.
+
+  A sentence of n tokens has min(n - start, W) such spans at each start, which
+  sums to m * n - m * (m - 1) / 2 with m = min(n, W).
+  """
+  n = np.asarray(sentence_lens, dtype=np.int64)
+  m = np.minimum(n, max_width)
+  return int((m * n - m * (m - 1) // 2).sum())
+
+
 def e2e_pred_set(tokens):
+  sentence_lens = [len(sentence) for sentence in tokens]
+  return (sum(sentence_lens) * MAX_SPAN_WIDTH,
+          width_bounded_span_count(sentence_lens))
+
+
+def encode_spans(spans, num_positions):
+  """Sorted unique integers, one per (start, end) span."""
+  spans = np.asarray(spans, dtype=np.int64).reshape(-1, 2)
+  return np.unique(spans[:, 0] * num_positions + spans[:, 1])
 
-  messy_counter = 0
-  for sentence in tokens:
-    for start in range(len(sentence)):
-      for end in range(start, len(sentence)):
-        if end - start < 30:
-          messy_counter += 1
-  return len(sum(tokens, [])) * 30, messy_counter
 
 def check_document(doc_obj):
-  inject_mentions = set(tuple(i) for i in doc_obj["inject_mentions"])
-  gold_mentions = set(tuple(i) for i in sum(doc_obj["clusters"], []))
+  """Counts for one document, in COUNT_FIELDS order."""
+  inject_spans = np.asarray(doc_obj["inject_mentions"], dtype=np.int64)
+  gold_spans = np.asarray(
+      [span for cluster in doc_obj["clusters"] for span in cluster],
+      dtype=np.int64)
+  num_positions = 1 + max([0] + [int(spans.max())
+                                 for spans in [inject_spans, gold_spans]
+                                 if spans.size])
+  inject_mentions = encode_spans(inject_spans, num_positions)
+  gold_mentions = encode_spans(gold_spans, num_positions)
 
-  tp = inject_mentions.intersection(gold_mentions)
-  fp = inject_mentions - gold_mentions
-  fn = gold_mentions - inject_mentions
-  num_e2e_spans, messy_counter = e2e_pred_set(doc_obj["sentences"])
+  tp = np.intersect1d(inject_mentions, gold_mentions, assume_unique=True).size
+  fp = inject_mentions.size - tp
+  fn = gold_mentions.size - tp
+  num_e2e_spans, width_bounded_spans = e2e_pred_set(doc_obj["sentences"])
+
+  return np.array([gold_mentions.size, tp, fp, fn, num_e2e_spans,
+                   width_bounded_spans], dtype=np.int64)
 
-  print("\t".join(
-      str(len(i)) for i in [gold_mentions, tp, fp, fn]) + "\t" + str(num_e2e_spans) + "\t" + str(messy_counter))
 
-  return tp, fp, fn
+def check_line(line):
+  return check_document(json.loads(line))
 
 
+def check_corpus(input_jsonl_file, num_workers=1):
+  """COUNT_FIELDS summed over every document of a jsonl file."""
+  totals = np.zeros(len(COUNT_FIELDS), dtype=np.int64)
+  with open(input_jsonl_file, 'r') as f:
+    lines = (line for line in f if line.strip())
+    if num_workers > 1:
+      document_counts = parallel_lib.ordered_map(
+          check_line, lines, num_workers, CHUNK_SIZE)
+    else:
+      document_counts = map(check_line, lines)
+    for counts in document_counts:
+      totals += counts
+  return collections.OrderedDict(zip(COUNT_FIELDS, totals.tolist()))
+
+
+def print_summary(counts):
+  gold, tp = counts["gold"], counts["tp"]
+  fields = list(counts.keys()) + ["recall", "precision"]
+  values = list(counts.values()) + [
+      tp / gold if gold else 0.0,
+      tp / (tp + counts["fp"]) if tp + counts["fp"] else 0.0]
+  print("\t".join(fields))
+  print("\t".join(
+      "{:.4f}".format(value) if isinstance(value, float) else str(value)
+      for value in values))
+
 
 def main():
   input_jsonl_file = sys.argv[1]
+  num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
 
-  problem_collector = collections.Counter()
-  
-  with open(input_jsonl_file, 'r') as f:
-    for line in f:
-      doc_obj = json.loads(line)
-      tp, fp, fn = check_document(doc_obj)
-      problem_collector["tp"] += len(tp)
-      problem_collector["fp"] += len(fp)
-      problem_collector["fn"] += len(fn)
-
-  print(problem_collector)
+  print_summary(check_corpus(input_jsonl_file, num_workers))
   
 
 if __name__ == "__main__":
@@ -0,0 +1 @@
+../convert/parallel_lib.py
\ No newline at end of file
@@ -1,49 +1,16 @@
-import collections
-import conll_lib
+import stats_lib
 import sys
 
-NONSPAN = "NONSPAN"
-VB_NONSPAN = "VB_NONSPAN"
-TOKEN = "TOKEN"
+STATISTICS = ["constituents", "coreferent", "token_pos"]
 
 def main():
   conll_file = sys.argv[1]
+  num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
 
-  list_dataset = conll_lib.listify_conll_dataset(conll_file)
+  # Overall constituents, coreferent spans, POS of token mentions
+  results = stats_lib.compute(conll_file, STATISTICS, num_workers)
 
-  overall_span_counter = collections.Counter()
-  coreferent_span_counter = collections.Counter()
-  token_span_pos_counter = collections.Counter()
-
-  for document in list_dataset:
-    for sentence in document[1:-1]:
-      sequences = conll_lib.get_sequences(sentence)
-      coref_clusters = conll_lib.build_coref_span_map(
-          sequences[conll_lib.LabelSequences.COREF])
-      all_coref_spans = sum(coref_clusters.values(), [])
-      parse_spans = conll_lib.build_parse_span_map(
-          sequences[conll_lib.LabelSequences.PARSE])
-
-      nonspans = set(all_coref_spans) - set(parse_spans.keys())
-      for start, end in nonspans:
-        if start == end:
-          if sequences["POS"][start].startswith("VB"):
-            coreferent_span_counter[VB_NONSPAN] += 1
-          else:
-            coreferent_span_counter[TOKEN] += 1
-            token_span_pos_counter[sequences["POS"][start]] += 1
-        else:
-          coreferent_span_counter[NONSPAN] += 1
-
-      for span, label in parse_spans.items():
-        condensed_label = label.replace("*", "")[1:-1]
-        overall_span_counter[condensed_label] += 1
-        if span in all_coref_spans:
-          coreferent_span_counter[condensed_label] += 1 
-      
-
-  for d in [overall_span_counter,
-            coreferent_span_counter, token_span_pos_counter]:
+  for d in results.values():
     for k, v in d.items():
       print(k+"\t"+str(v))
     print()
@@ -0,0 +1 @@
+../convert/span_lib.py
\ No newline at end of file
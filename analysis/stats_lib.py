@@ -0,0 +1,196 @@
+"""Mergeable corpus statistics over CoNLL files, computed as plugins.
+
+Documents are loaded into a columnar_lib.ColumnarCorpus, and every statistic
+is a plugin that counts over its arrays. Keys of the resulting Counters are in
+order of first occurrence in the corpus. Documents can be counted in worker
+processes, each loading a contiguous shard of the file through conll_lib's
+byte-offset index; partials are merged in file order, so the merged Counters
+(key order included) are the same as counting the whole file at once.
+
+Results are cached per plugin in a <file>.stats.json sidecar, invalidated when
+the file's size or mtime changes, so adding a plugin only scans the corpus for
+that plugin.
+"""
+
+import collections
+import os
+
+import numpy as np
+
+import columnar_lib
+import conll_lib
+import parallel_lib
+
+STATS_SUFFIX = ".stats.json"
+SHARDS_PER_WORKER = 4
+
+NONSPAN = "NONSPAN"
+VB_NONSPAN = "VB_NONSPAN"
+TOKEN = "TOKEN"
+NONSPAN_KINDS = [VB_NONSPAN, TOKEN, NONSPAN]
+
+# Only the columns the statistics look at are loaded
+FIELD_MAP = collections.OrderedDict(
+    (field, conll_lib.CONLL_FIELD_MAP[field]) for field in [
+        conll_lib.LabelSequences.POS, conll_lib.LabelSequences.PARSE,
+        conll_lib.LabelSequences.COREF])
+
+# What all plugins share about one corpus: coref mentions that aren't
+# constituents, in order of first occurrence, with their sentences and kind
+# (index into NONSPAN_KINDS), and which constituents are coref mentions.
+CorpusView = collections.namedtuple(
+    "CorpusView", ["corpus", "nonspans", "nonspan_sentences", "nonspan_kinds",
+                   "coreferent"])
+
+
+def _span_keys(corpus, spans):
+  return spans[:, 0].astype(np.int64) * (corpus.num_tokens + 1) + spans[:, 1]
+
+
+def corpus_view(corpus):
+  coref_keys = _span_keys(corpus, corpus.coref_spans)
+  parse_keys = _span_keys(corpus, corpus.parse_spans)
+  # Mentions of several clusters count once
+  _, first_rows = np.unique(coref_keys, return_index=True)
+  first_rows.sort()
+  nonspans = corpus.coref_spans[first_rows[
+      ~np.isin(coref_keys[first_rows], parse_keys)]]
+
+  pos_vocab = corpus.vocabs[conll_lib.LabelSequences.POS]
+  is_verb = np.array([pos.startswith("VB") for pos in pos_vocab.strings],
+                     dtype=bool)
+  is_token = nonspans[:, 0] == nonspans[:, 1]
+  token_is_verb = is_verb[
+      corpus.columns[conll_lib.LabelSequences.POS][nonspans[:, 0]]]
+  kinds = np.where(is_token, np.where(token_is_verb, 0, 1), 2)
+  return CorpusView(corpus, nonspans, corpus.span_sentence_ids(nonspans),
+                    kinds, np.isin(parse_keys, coref_keys))
+
+
+def _ordered_counter(names, ids):
+  """Counter of names[i] for ids, keys in the order ids first appear."""
+  unique_ids, first, counts = np.unique(
+      ids, return_index=True, return_counts=True)
+  counter = collections.Counter()
+  for i in np.argsort(first).tolist():
+    counter[names[unique_ids[i]]] = int(counts[i])
+  return counter
+
+
+def count_constituents(view):
+  corpus = view.corpus
+  return _ordered_counter(
+      corpus.vocabs[conll_lib.LabelSequences.PARSE].strings,
+      corpus.parse_labels)
+
+
+def count_coreferent(view):
+  """Coreferent constituents by label, and coreferent non-constituents.
+
+  Within a sentence, its non-constituents come before its constituents.
+  """
+  corpus = view.corpus
+  coreferent_spans = corpus.parse_spans[view.coreferent]
+  sentences = np.concatenate(
+      [view.nonspan_sentences, corpus.span_sentence_ids(coreferent_spans)])
+  ids = np.concatenate([view.nonspan_kinds, len(NONSPAN_KINDS)
+                        + corpus.parse_labels[view.coreferent]])
+  order = np.argsort(sentences, kind='stable')
+  return _ordered_counter(
+      NONSPAN_KINDS + corpus.vocabs[conll_lib.LabelSequences.PARSE].strings,
+      ids[order])
+
+
+def count_token_pos(view):
+  """POS tags of single-token, non-verb, non-constituent mentions."""
+  corpus = view.corpus
+  tokens = view.nonspans[view.nonspan_kinds == NONSPAN_KINDS.index(TOKEN), 0]
+  return _ordered_counter(
+      corpus.vocabs[conll_lib.LabelSequences.POS].strings,
+      corpus.columns[conll_lib.LabelSequences.POS][tokens])
+
+
+# Name -> (version, fn), where fn(view) is the partial Counter for the
+# corpus_view of a ColumnarCorpus. Bump the version after changing fn, so
+# results cached with the old one are recomputed.
+STATISTICS = collections.OrderedDict()
+
+def register_statistic(name, fn, version=1):
+  STATISTICS[name] = (version, fn)
+  return fn
+
+
+def cache_key(name):
+  version, _ = STATISTICS[name]
+  return "{}@{}".format(name, version)
+
+
+register_statistic("constituents", count_constituents, version=2)
+register_statistic("coreferent", count_coreferent, version=2)
+register_statistic("token_pos", count_token_pos, version=2)
+
+
+def count_corpus(corpus, names):
+  view = corpus_view(corpus)
+  return [STATISTICS[name][1](view) for name in names]
+
+
+_WORKER_STATE = None
+
+def _init_count_worker(conll_file, names):
+  global _WORKER_STATE
+  _WORKER_STATE = (conll_lib.ConllDocumentReader(conll_file), names)
+
+
+def _count_in_worker(doc_keys):
+  reader, names = _WORKER_STATE
+  return count_corpus(columnar_lib.ColumnarCorpus.from_documents(
+      reader.iter_documents(doc_keys), FIELD_MAP), names)
+
+
+def scan(conll_file, names, num_workers=1):
+  """Count the named statistics over the whole file, in one pass.
+
+  Returns an OrderedDict from name to merged Counter.
+  """
+  merged = collections.OrderedDict(
+      (name, collections.Counter()) for name in names)
+  if num_workers > 1:
+    # Workers read their shards from the file themselves; only doc keys and
+    # small partial counters cross process boundaries
+    num_shards = num_workers * SHARDS_PER_WORKER
+    with conll_lib.ConllDocumentReader(conll_file) as reader:
+      shards = [reader.shard(i, num_shards) for i in range(num_shards)]
+    partials = parallel_lib.ordered_map(
+        _count_in_worker, shards, num_workers, 1,
+        initializer=_init_count_worker, initargs=(conll_file, names))
+  else:
+    partials = [count_corpus(
+        columnar_lib.ColumnarCorpus.from_conll(conll_file, FIELD_MAP), names)]
+  for corpus_partials in partials:
+    for name, partial in zip(names, corpus_partials):
+      merged[name].update(partial) # update, unlike +=, keeps zero counts
+  return merged
+
+
+def compute(conll_file, names, num_workers=1, use_cache=True):
+  """The named statistics for a CoNLL file, scanning only for uncached ones.
+
+  Returns an OrderedDict from name to Counter.
+  """
+  stat = os.stat(conll_file)
+  cached = {}
+  if use_cache:
+    cached = conll_lib.read_sidecar(conll_file, STATS_SUFFIX) or {}
+  missing = [name for name in names
+             if cache_key(name) not in cached]
+  if missing:
+    for name, counter in scan(conll_file, missing, num_workers).items():
+      # Pairs rather than a dict, so key order survives the round trip
+      cached[cache_key(name)] = list(counter.items())
+    if use_cache:
+      conll_lib.write_sidecar(conll_file, STATS_SUFFIX, cached, stat)
+  return collections.OrderedDict(
+      (name, collections.Counter(
+          collections.OrderedDict(cached[cache_key(name)])))
+      for name in names)
@@ -0,0 +1,114 @@
+"""Regression check for applying alternate labels to the longest documents.
+
+The old code took labels off the front of a list (labels.pop(0)), which is
+quadratic in document length; only the longest documents show it. On single
+synthetic documents of doubling length, with the sing variant's mentions,
+this checks create_additional_labels and iter_labelled_sentences against the
+old versions, and that they grow linearly and are no slower than the old ones.
+
+  python bench_apply_labels.py [largest_num_sentences]
+"""
+
+import sys
+
+import bench_lib
+import conll_alternates
+import conll_lib
+import convert_lib
+
+
+def reference_create_additional_labels(new_mentions, cluster_offset, doc_len):
+  labels = ["" for _ in range(doc_len)]
+  for i, (start, end) in enumerate(sorted(new_mentions)):
+    cluster_id = "s" + str(i + cluster_offset)
+    if labels[start]:
+      labels[start] += "|"
+    if start == end:
+      labels[start] += "({0})".format(cluster_id)
+    else:
+      labels[start] += "({0}".format(cluster_id)
+      if labels[end]:
+        labels[end] += "|"
+      labels[end] += "{0})".format(cluster_id)
+  return labels
+
+
+def reference_apply_labels(document, labels):
+  """Labels `document` in place, consuming `labels`."""
+  for sent in document[1:-1]:
+    for i, word in enumerate(sent):
+      label = labels.pop(0)
+      if not label:
+        continue
+      elif word[conll_alternates.COREF_IDX] == "-":
+        sent[i][conll_alternates.COREF_IDX] = label
+      else:
+        sent[i][conll_alternates.COREF_IDX] += "|" + label
+  return document
+
+
+class Case(object):
+  """One long synthetic document with its sing mentions and labels."""
+  def __init__(self, num_sentences):
+    (self.document,) = bench_lib.synthetic_conll_documents(
+        1, num_sentences, seed=num_sentences)
+    span_index = conll_alternates.SpanIndex()
+    offset = 0
+    self.cluster_offset = 0
+    for sent in self.document[1:-1]:
+      _, coref_map, parse_map = conll_lib.parse_sentence(sent, offset)
+      span_index.add_sentence(coref_map, parse_map)
+      offset += len(sent)
+      self.cluster_offset = max(
+          [self.cluster_offset] + [int(i) + 1 for i in coref_map])
+    self.doc_len = offset
+    self.mentions = conll_alternates.FN_MAP[convert_lib.Variation.sing](
+        span_index)
+    self.labels = conll_alternates.create_additional_labels(
+        self.mentions, self.cluster_offset, self.doc_len)
+
+  def create_labels(self):
+    return conll_alternates.create_additional_labels(
+        self.mentions, self.cluster_offset, self.doc_len)
+
+  def reference_create_labels(self):
+    return reference_create_additional_labels(
+        self.mentions, self.cluster_offset, self.doc_len)
+
+  def apply_labels(self):
+    return list(conll_alternates.iter_labelled_sentences(
+        self.document, self.labels))
+
+  def reference_apply_labels(self):
+    # Copies the rows it mutates; linear, so the pops still dominate
+    document = [[list(word) for word in sent] for sent in self.document]
+    return reference_apply_labels(document, list(self.labels))[1:-1]
+
+
+def main():
+  largest = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+  sizes = [largest >> shift for shift in range(3, -1, -1)]
+  cases = {size: Case(size) for size in sizes}
+
+  benchmark = bench_lib.Benchmark("bench_apply_labels")
+  paths = [
+      ("create_additional_labels", Case.create_labels,
+       Case.reference_create_labels),
+      ("iter_labelled_sentences", Case.apply_labels,
+       Case.reference_apply_labels),
+  ]
+  for label, fn, reference_fn in paths:
+    benchmark.check(
+        all(fn(case) == reference_fn(case) for case in cases.values()),
+        "{} matches the reference".format(label))
+    seconds = benchmark.time_sizes(
+        label, lambda size: fn(cases[size]), sizes)
+    reference_seconds = benchmark.time_sizes(
+        label + " reference", lambda size: reference_fn(cases[size]), sizes)
+    benchmark.check_linear(label, sizes, seconds)
+    benchmark.check_speedup(label, seconds[-1], reference_seconds[-1])
+  benchmark.exit()
+
+
+if __name__ == "__main__":
+  main()
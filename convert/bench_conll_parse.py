@@ -0,0 +1,149 @@
+"""Checks conll_lib.parse_sentence against the parser it replaced.
+
+Before, every sentence was scanned once per column by get_sequences, then
+again by build_coref_span_map and build_parse_span_map; the latter split
+parse labels a character at a time and kept its stack at the front of a list.
+Those functions are kept below as the reference.
+
+Writes a synthetic CoNLL file of 64k sentences, reads it back, and checks
+that parse_sentence returns exactly what the reference returns for every
+sentence. Then times both ways of parsing growing prefixes of the file, and
+compares them taking turns on a quarter of it.
+
+  python bench_conll_parse.py [num_sentences]
+"""
+
+import collections
+import os
+import sys
+import tempfile
+
+import bench_lib
+import conll_lib
+
+SENTENCES_PER_DOCUMENT = 64
+# The single pass measures 1.2-1.4x the reference; this leaves room for noise
+MIN_SPEEDUP = 1.1
+# The two parsers take turns this many times on a quarter of the file
+SPEEDUP_REPEATS = 7
+
+
+def reference_get_sequences(sentence, field_map=conll_lib.CONLL_FIELD_MAP):
+  sequences = {}
+  for field, index in field_map.items():
+    sequences[field] = conll_lib.get_index(sentence, index)
+  return sequences
+
+
+def reference_build_coref_span_map(coref_col, offset=0):
+  span_starts = collections.defaultdict(list)
+  complete_spans = []
+  for i, orig_label in enumerate(coref_col):
+    if orig_label == '-':
+      continue
+    for label in orig_label.split("|"):
+      if label.startswith("("):
+        if label.endswith(")"):
+          complete_spans.append((i, i, label[1:-1]))
+        else:
+          span_starts[label[1:]].append(i)
+      elif label.endswith(")"):
+        ending_cluster = label[:-1]
+        assert len(span_starts[ending_cluster]) in [1, 2]
+        start_idx = span_starts[ending_cluster].pop(-1)
+        complete_spans.append((start_idx, i, ending_cluster))
+
+  span_dict = collections.defaultdict(list)
+  for start, end, cluster in complete_spans:
+    span_dict[cluster].append((offset + start, offset + end))
+  return span_dict
+
+
+def reference_split_parse_label(label):
+  curr_chunk = ""
+  chunks = []
+  for c in label:
+    if c in "()":
+      if curr_chunk:
+        chunks.append(curr_chunk)
+      curr_chunk = c
+    else:
+      curr_chunk += c
+  chunks.append(curr_chunk)
+  return chunks
+
+
+def reference_build_parse_span_map(parse_col, offset=0):
+  stack = []
+  label_map = {}
+  for i, orig_label in enumerate(parse_col):
+    for label in reference_split_parse_label(orig_label):
+      if label.startswith("("):
+        stack.insert(0, [label, i + offset])
+      elif label.endswith(")"):
+        span_prefix, start_idx = stack.pop(0)
+        label_map[(start_idx, i + offset)] = span_prefix + label
+      else:
+        stack[0][0] += label
+  return label_map
+
+
+def reference_parse(sentence, offset=0):
+  sequences = reference_get_sequences(sentence)
+  return (sequences,
+          reference_build_coref_span_map(
+              sequences[conll_lib.LabelSequences.COREF], offset),
+          reference_build_parse_span_map(
+              sequences[conll_lib.LabelSequences.PARSE], offset))
+
+
+def read_sentences(conll_file):
+  """Every sentence of the file with its document-relative token offset."""
+  sentences = []
+  for document in conll_lib.iter_conll_dataset(conll_file):
+    offset = 0
+    for sentence in document[1:-1]:
+      sentences.append((sentence, offset))
+      offset += len(sentence)
+  return sentences
+
+
+def main():
+  num_sentences = int(sys.argv[1]) if len(sys.argv) > 1 else 1 << 16
+  with tempfile.TemporaryDirectory() as temp_dir:
+    conll_file = os.path.join(temp_dir, "synthetic.conll")
+    with open(conll_file, 'w') as f:
+      f.writelines(bench_lib.synthetic_conll_lines(
+          num_sentences // SENTENCES_PER_DOCUMENT, SENTENCES_PER_DOCUMENT))
+    sentences = read_sentences(conll_file)
+
+  benchmark = bench_lib.Benchmark("bench_conll_parse")
+  benchmark.check(
+      all(conll_lib.parse_sentence(sentence, offset)
+          == reference_parse(sentence, offset)
+          for sentence, offset in sentences),
+      "parse_sentence matches the reference on {} sentences".format(
+          len(sentences)))
+
+  def parse_all(parse_fn):
+    return lambda size: [parse_fn(sentence, offset)
+                         for sentence, offset in sentences[:size]]
+
+  sizes = [len(sentences) >> shift for shift in range(3, -1, -1)]
+  seconds = benchmark.time_sizes(
+      "parse_sentence", parse_all(conll_lib.parse_sentence), sizes)
+  reference_seconds = benchmark.time_sizes(
+      "reference", parse_all(reference_parse), sizes)
+  benchmark.check_linear("parse_sentence", sizes, seconds)
+  speedup_size = sizes[1]
+  benchmark.check_speedup(
+      "parse_sentence", *bench_lib.best_times(
+          [lambda: parse_all(conll_lib.parse_sentence)(speedup_size),
+           lambda: parse_all(reference_parse)(speedup_size)],
+          repeats=SPEEDUP_REPEATS),
+      min_speedup=MIN_SPEEDUP)
+  benchmark.exit()
+
+
+if __name__ == "__main__":
+  main()
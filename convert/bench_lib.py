@@ -0,0 +1,200 @@
+"""Shared harness for the bench_*.py scaling and regression checks.
+
+Each check times a stage at growing input sizes and fails (exits non-zero) if
+its run time grows faster than linearly, or if a fast path disagrees with its
+reference implementation.
+"""
+
+import gc
+import math
+import random
+import sys
+import time
+
+import conll_lib
+import convert_lib
+
+DEFAULT_REPEATS = 3
+# Slope of log(time) against log(size); 1 is linear, 2 quadratic. Leaves room
+# for timer noise and cache effects at the small sizes.
+MAX_EXPONENT = 1.3
+
+
+def best_time(fn, *args, repeats=DEFAULT_REPEATS):
+  """Fastest of `repeats` wall times of fn(*args), in seconds.
+
+  As in timeit, the garbage collector is off while timing, since its cost
+  grows with every object still alive (e.g. the other sizes' inputs).
+  """
+  return best_times([lambda: fn(*args)], repeats=repeats)[0]
+
+
+def best_times(fns, repeats=DEFAULT_REPEATS):
+  """Fastest of `repeats` wall times of each of fns, which take turns.
+
+  Timed in turns, both sides of a comparison see the same load on the
+  machine, so their ratio is steadier than that of separate best_time calls.
+  """
+  times = [[] for _ in fns]
+  gc_was_enabled = gc.isenabled()
+  gc.disable()
+  try:
+    for _ in range(repeats):
+      for fn, fn_times in zip(fns, times):
+        start_time = time.perf_counter()
+        fn()
+        fn_times.append(time.perf_counter() - start_time)
+  finally:
+    if gc_was_enabled:
+      gc.enable()
+  return [min(fn_times) for fn_times in times]
+
+
+def scaling_exponent(sizes, seconds):
+  """Least-squares slope of log(seconds) against log(sizes)."""
+  xs = [math.log(size) for size in sizes]
+  ys = [math.log(max(s, 1e-9)) for s in seconds]
+  mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+  return (sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+          / sum((x - mean_x) ** 2 for x in xs))
+
+
+class Benchmark(object):
+  """Collects named checks and reports them; see `exit`."""
+  def __init__(self, name):
+    self.name = name
+    self.failures = []
+
+  def check(self, ok, message):
+    print("{}: {}".format("ok" if ok else "FAIL", message))
+    if not ok:
+      self.failures.append(message)
+    return ok
+
+  def time_sizes(self, label, fn, sizes, repeats=DEFAULT_REPEATS):
+    """Time fn(size) at each size; returns the list of best times."""
+    seconds = []
+    for size in sizes:
+      seconds.append(best_time(fn, size, repeats=repeats))
+      print("  {}\tsize {}\t{:.4f}s".format(label, size, seconds[-1]))
+    return seconds
+
+  def check_linear(self, label, sizes, seconds, max_exponent=MAX_EXPONENT):
+    exponent = scaling_exponent(sizes, seconds)
+    return self.check(exponent <= max_exponent,
+                      "{} scales as size^{:.2f} (limit {})".format(
+                          label, exponent, max_exponent))
+
+  def check_speedup(self, label, fast_seconds, reference_seconds,
+                    min_speedup=1.0):
+    speedup = reference_seconds / max(fast_seconds, 1e-9)
+    return self.check(speedup >= min_speedup,
+                      "{} is {:.2f}x the reference (limit {}x)".format(
+                          label, speedup, min_speedup))
+
+  def exit(self):
+    if self.failures:
+      print("{}: {} check(s) failed".format(self.name, len(self.failures)))
+      sys.exit(1)
+    print("{}: all checks passed".format(self.name))
+
+
+class SplitTokenizer(object):
+  """Stand-in for the BERT tokenizer: splits tokens into 3-character pieces.
+
+  Keeps the benchmarks free of the vocab file and of TensorFlow.
+  """
+  def tokenize(self, token):
+    return [token[:3]] + ["##" + token[i:i + 3]
+                          for i in range(3, len(token), 3)]
+
+  def convert_tokens_to_ids(self, tokens):
+    return [hash(token) % 30000 for token in tokens]
+
+
+def synthetic_document(num_sentences, sentence_len=20, mentions_per_sentence=3,
+                       max_mention_width=4, cluster_size=3, seed=0):
+  """A TOKENIZED CorefDocument of random words, mentions and clusters.
+
+  Clusters of `cluster_size` mentions are drawn from anywhere in the
+  document; with a cluster_size of 1, the singletons stay in document order.
+  """
+  rng = random.Random(seed)
+  document = convert_lib.CorefDocument(
+      "synthetic", 0, init_status=convert_lib.ProcessingStage.TOKENIZED)
+  mentions = []
+  for sentence_index in range(num_sentences):
+    offset = sentence_index * sentence_len
+    document.sentences.append(
+        ["word{}".format(rng.randrange(5000)) for _ in range(sentence_len)])
+    document.speakers.append(["speaker"] * sentence_len)
+    for _ in range(mentions_per_sentence):
+      start = rng.randrange(sentence_len)
+      end = min(start + rng.randrange(max_mention_width), sentence_len - 1)
+      mentions.append([offset + start, offset + end])
+  if cluster_size > 1:
+    rng.shuffle(mentions)
+  document.set_mentions([mentions[i:i + cluster_size]
+                         for i in range(0, len(mentions), cluster_size)])
+  return document
+
+
+PARSE_LABELS = ["NP", "VP", "S", "PP", "ADJP", "SBAR"]
+WORDS = ["the", "cat", "extraordinarily", "sat", "on", "mat", "Washington",
+         "a", "He", "said"]
+POS_TAGS = ["DT", "NN", "RB", "VBD", "IN", "NNP", "PRP", "VBZ"]
+
+
+def _synthetic_parse(rng, num_tokens, depth=0):
+  """Parse column of a random tree over num_tokens tokens."""
+  if num_tokens == 1 or depth > 6:
+    bits = ["*"] * num_tokens
+  else:
+    num_children = rng.randint(1, min(3, num_tokens))
+    cuts = sorted(rng.sample(range(1, num_tokens), num_children - 1))
+    bits = []
+    for start, end in zip([0] + cuts, cuts + [num_tokens]):
+      bits += _synthetic_parse(rng, end - start, depth + 1)
+  if num_tokens > 1 or rng.random() < 0.5:
+    bits[0] = "(" + rng.choice(PARSE_LABELS) + bits[0]
+    bits[-1] += ")"
+  return bits
+
+
+def synthetic_conll_lines(num_documents, sentences_per_document,
+                          max_sentence_len=25, seed=0):
+  """Lines of an OntoNotes-like CoNLL file with nested parses and coref."""
+  rng = random.Random(seed)
+  for doc_index in range(num_documents):
+    doc_name = "bc/cnn/00/doc_{}".format(doc_index)
+    yield "#begin document ({}); part 000\n".format(doc_name)
+    for sentence_index in range(sentences_per_document):
+      num_tokens = rng.randint(1, max_sentence_len)
+      parse = _synthetic_parse(rng, num_tokens)
+      parse[0] = "(TOP" + parse[0]
+      parse[-1] += ")"
+      coref = [[] for _ in range(num_tokens)]
+      # Distinct clusters, so no cluster has nested mentions of itself
+      for cluster in rng.sample(range(7), rng.randint(0, 4)):
+        start = rng.randrange(num_tokens)
+        end = min(num_tokens - 1, start + rng.randint(0, 3))
+        if start == end:
+          coref[start].append("({})".format(cluster))
+        else:
+          coref[start].append("({}".format(cluster))
+          coref[end].append("{})".format(cluster))
+      speaker = "speaker{}".format(sentence_index % 2)
+      for i in range(num_tokens):
+        yield "\t".join([
+            doc_name, "0", str(i), rng.choice(WORDS), rng.choice(POS_TAGS),
+            parse[i], "-", "-", "-", speaker, "*",
+            "|".join(coref[i]) or "-"]) + "\n"
+      yield "\n"
+    yield "#end document\n"
+
+
+def synthetic_conll_documents(num_documents, sentences_per_document,
+                              seed=0):
+  """Listified documents, as conll_lib.iter_conll_dataset yields them."""
+  return list(conll_lib.iter_conll_lines(synthetic_conll_lines(
+      num_documents, sentences_per_document, seed=seed)))
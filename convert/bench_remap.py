@@ -0,0 +1,140 @@
+"""Checks the array mention remapping against per-span Python loops.
+
+Sing-variant documents have a mention for nearly every constituent, mostly
+singletons, so remapping mentions is a large share of their conversion. On
+synthetic documents like that, this times, at doubling sizes:
+
+  bpe       token -> subtoken spans, as bpe_variant does it
+  segment   subtoken -> segmented spans via segment_mentions, in sentence mode
+  windows   the same with overlapping windows (remap_windowed_spans)
+
+Documents keep their mentions as span_lib arrays from reading to output, so
+each array stage is timed from arrays to arrays, and each loop from nested
+lists to nested lists, as documents held them before. Both are checked for
+the same mentions, for linear growth in document length, and against a
+floor on the arrays' speedup over the loop on the largest document.
+
+  python bench_remap.py [largest_num_sentences]
+"""
+
+import sys
+
+import bench_lib
+import convert_lib
+import span_lib
+
+SING_MENTIONS_PER_SENTENCE = 15
+MAX_SEGMENT_LEN = 384
+STRIDE = 256
+# Minimum speedup over the loop; the arrays measure about 35x (bpe), 45x
+# (segment) and 750x (windows)
+MIN_SPEEDUPS = {"bpe": 10.0, "segment": 10.0, "windows": 100.0}
+
+
+def reference_remap_clusters(clusters, start_offsets, end_offsets,
+                             cumulative=False):
+  new_clusters = []
+  for cluster in clusters:
+    new_cluster = []
+    for start, end in cluster:
+      if cumulative:
+        new_cluster.append([start + start_offsets[start],
+                            end + end_offsets[end]])
+      else:
+        new_cluster.append([start_offsets[start], end_offsets[end]])
+    new_clusters.append(new_cluster)
+  return new_clusters
+
+
+def reference_remap_windowed(clusters, segment_ranges):
+  """First window containing each span, searched span by span."""
+  new_clusters = []
+  for cluster in clusters:
+    new_cluster = []
+    for start, end in cluster:
+      flat_start = 0
+      for first, last in segment_ranges:
+        if first <= start and end < last:
+          offset = flat_start + 1 - first
+          new_cluster.append([start + offset, end + offset])
+          break
+        flat_start += last - first + 2
+    if new_cluster:
+      new_clusters.append(new_cluster)
+  return new_clusters
+
+
+class Case(object):
+  """One synthetic sing-like document and what each remap path needs."""
+  def __init__(self, num_sentences, tokenizer):
+    self.document = bench_lib.synthetic_document(
+        num_sentences, mentions_per_sentence=SING_MENTIONS_PER_SENTENCE,
+        cluster_size=1, seed=num_sentences)
+    self.bpe_document = convert_lib.bpe_tokenize_document(
+        self.document, tokenizer)
+    self.segmented = {
+        stride: next(iter(convert_lib.segment_document_multi(
+            self.bpe_document, [MAX_SEGMENT_LEN], stride).values()))
+        for stride in [None, STRIDE]}
+    # What the loops take
+    self.token_clusters = self.document.clusters
+    self.subtoken_clusters = self.bpe_document.clusters
+    self.bpe_maps = [subtokens.tolist()
+                     for subtokens in self.bpe_document.bpe_maps]
+    self.subtoken_offsets = self.segmented[None].subtoken_offsets.tolist()
+
+  def array_bpe(self):
+    starts, ends = self.bpe_document.bpe_maps
+    return (convert_lib.remap_spans(self.document.mention_spans, starts, ends),
+            self.document.mention_cluster_ids, self.document.num_clusters)
+
+  def reference_bpe(self):
+    starts, ends = self.bpe_maps
+    return reference_remap_clusters(self.token_clusters, starts, ends)
+
+  def array_segment(self, stride):
+    seg_document = self.segmented[stride]
+    return convert_lib.segment_mentions(
+        self.bpe_document, seg_document.segment_ranges,
+        seg_document.subtoken_offsets)[:3]
+
+  def reference_segment(self, stride):
+    if stride is None:
+      return reference_remap_clusters(
+          self.subtoken_clusters, self.subtoken_offsets, self.subtoken_offsets,
+          cumulative=True)
+    return reference_remap_windowed(
+        self.subtoken_clusters, self.segmented[stride].segment_ranges)
+
+
+def main():
+  largest = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+  sizes = [largest >> shift for shift in range(3, -1, -1)]
+  tokenizer = bench_lib.SplitTokenizer()
+  cases = {size: Case(size, tokenizer) for size in sizes}
+
+  benchmark = bench_lib.Benchmark("bench_remap")
+  paths = [
+      ("bpe", lambda case: case.array_bpe(), lambda case: case.reference_bpe()),
+      ("segment", lambda case: case.array_segment(None),
+       lambda case: case.reference_segment(None)),
+      ("windows", lambda case: case.array_segment(STRIDE),
+       lambda case: case.reference_segment(STRIDE)),
+  ]
+  for label, array_fn, reference_fn in paths:
+    benchmark.check(
+        all(span_lib.decode_mentions(*array_fn(case))[0]
+            == reference_fn(case) for case in cases.values()),
+        "{} matches the reference".format(label))
+    array_seconds = benchmark.time_sizes(
+        label, lambda size: array_fn(cases[size]), sizes)
+    reference_seconds = benchmark.time_sizes(
+        label + " reference", lambda size: reference_fn(cases[size]), sizes)
+    benchmark.check_linear(label, sizes, array_seconds)
+    benchmark.check_speedup(label, array_seconds[-1], reference_seconds[-1],
+                            MIN_SPEEDUPS[label])
+  benchmark.exit()
+
+
+if __name__ == "__main__":
+  main()
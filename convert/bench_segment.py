@@ -0,0 +1,37 @@
+"""Checks that segmentation time grows linearly with document length.
+
+Times segment_document_multi, in sentence mode and in window mode, on one BPE
+document per size, doubling the number of sentences each time.
+
+  python bench_segment.py [largest_num_sentences]
+"""
+
+import sys
+
+import bench_lib
+import convert_lib
+
+STRIDE = 128
+
+
+def main():
+  largest = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+  sizes = [largest >> shift for shift in range(4, -1, -1)]
+  tokenizer = bench_lib.SplitTokenizer()
+  bpe_documents = {
+      size: convert_lib.bpe_tokenize_document(
+          bench_lib.synthetic_document(size), tokenizer)
+      for size in sizes}
+
+  benchmark = bench_lib.Benchmark("bench_segment")
+  for label, stride in [("sentences", None), ("windows", STRIDE)]:
+    seconds = benchmark.time_sizes(
+        label, lambda size: convert_lib.segment_document_multi(
+            bpe_documents[size], convert_lib.DEFAULT_SEGMENT_LENS, stride),
+        sizes)
+    benchmark.check_linear(label, sizes, seconds)
+  benchmark.exit()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,193 @@
+"""Memory-mappable binary format for segmented documents.
+
+Each segmented stage gets a directory next to its jsonl file holding one flat
+little-endian array per field, concatenated over all documents, plus an offset
+table saying where each document's slice starts in each group of fields:
+
+  subtoken_ids      int32  (num_subtokens,)
+  sentence_map      int32  (num_subtokens,)
+  subtoken_map      int32  (num_subtokens,)
+  segment_lens      int32  (num_segments,)
+  cluster_spans     int32  (num_mentions, 2)
+  cluster_ids       int32  (num_mentions,)
+  injected_spans    int32  (num_injected, 2)
+  doc_offsets       int64  (num_documents + 1, num_groups)
+  index.json        doc_keys in file order, the groups in doc_offsets' column
+                    order, and optionally shared_dir
+
+Variants that differ from another stage directory only in their mentions (the
+PreCo inject types) write just the mention groups, and name the directory
+holding the subtoken and segment arrays as shared_dir, relative to their own.
+
+BinaryCorpus maps the arrays with np.memmap and hands out zero-copy slices.
+"""
+
+import collections
+import json
+import os
+
+import numpy as np
+
+import span_lib
+
+OFFSET_DTYPE = np.dtype("<i8")
+
+SUBTOKEN_FIELDS = ["subtoken_ids", "sentence_map", "subtoken_map"]
+SEGMENT_FIELDS = ["segment_lens"]
+MENTION_FIELDS = ["cluster_spans", "cluster_ids"]
+INJECTED_FIELDS = ["injected_spans"]
+# Each group's fields share one column of doc_offsets
+GROUP_FIELDS = collections.OrderedDict([
+    ("subtoken", SUBTOKEN_FIELDS), ("segment", SEGMENT_FIELDS),
+    ("mention", MENTION_FIELDS), ("injected", INJECTED_FIELDS)])
+GROUPS = list(GROUP_FIELDS.keys())
+MENTION_GROUPS = ["mention", "injected"]
+FIELDS = [field for fields in GROUP_FIELDS.values() for field in fields]
+SPAN_FIELDS = ["cluster_spans", "injected_spans"] # Shape (n, 2)
+INDEX_FILE = "index.json"
+OFFSETS_FILE = "doc_offsets"
+
+
+def binary_dir_name(jsonl_file_name):
+  assert jsonl_file_name.endswith(".jsonl")
+  return jsonl_file_name[:-len(".jsonl")] + ".bin"
+
+
+def encode_mentions(doc_key, spans, cluster_ids, num_clusters):
+  """Arrays of the mention groups alone, for a writer with MENTION_GROUPS.
+
+  Takes mentions as span_lib arrays.
+  """
+  num_cluster_spans = int(np.searchsorted(cluster_ids, num_clusters))
+  return {
+    "doc_key": doc_key,
+    "cluster_spans": spans[:num_cluster_spans],
+    "cluster_ids": cluster_ids[:num_cluster_spans],
+    "injected_spans": spans[num_cluster_spans:],
+  }
+
+
+def encode_document(seg_document, tokenizer):
+  """Arrays for one segmented CorefDocument; cheap to pickle between processes."""
+  subtokens = [subtoken for segment in seg_document.sentences
+               for subtoken in segment]
+  record = encode_mentions(
+      seg_document.doc_id + "_" + str(int(seg_document.doc_part)),
+      seg_document.mention_spans, seg_document.mention_cluster_ids,
+      seg_document.num_clusters)
+  record.update({
+    "subtoken_ids": np.asarray(tokenizer.convert_tokens_to_ids(subtokens),
+                               dtype=span_lib.INDEX_DTYPE),
+    "sentence_map": np.asarray(seg_document.sentence_map,
+                               dtype=span_lib.INDEX_DTYPE),
+    "subtoken_map": np.asarray(seg_document.subtoken_map,
+                               dtype=span_lib.INDEX_DTYPE),
+    "segment_lens": np.asarray(
+        [len(segment) for segment in seg_document.sentences],
+        dtype=span_lib.INDEX_DTYPE),
+  })
+  return record
+
+
+class BinaryWriter(object):
+  """Appends encoded documents to the arrays of one stage directory.
+
+  Only the fields of `groups` are written; with `shared_dir`, readers take
+  the other groups from that stage directory.
+  """
+  def __init__(self, dir_name, groups=GROUPS, shared_dir=None):
+    if not os.path.isdir(dir_name):
+      os.makedirs(dir_name)
+    self.dir_name = dir_name
+    self.groups = list(groups)
+    self.shared_dir = shared_dir
+    self.files = collections.OrderedDict(
+        (field, open(os.path.join(dir_name, field), 'wb'))
+        for group in self.groups for field in GROUP_FIELDS[group])
+    # Field whose length counts a group's entries in each document
+    self.count_fields = [GROUP_FIELDS[group][0] for group in self.groups]
+    self.doc_keys = []
+    self.offsets = [tuple(0 for _ in self.groups)]
+
+  def write(self, record):
+    for field, f in self.files.items():
+      f.write(record[field].tobytes())
+    self.offsets.append(tuple(
+        offset + len(record[field])
+        for offset, field in zip(self.offsets[-1], self.count_fields)))
+    self.doc_keys.append(record["doc_key"])
+
+  def close(self):
+    for f in self.files.values():
+      f.close()
+    with open(os.path.join(self.dir_name, OFFSETS_FILE), 'wb') as f:
+      f.write(np.asarray(self.offsets, dtype=OFFSET_DTYPE).tobytes())
+    index = {"doc_keys": self.doc_keys, "groups": self.groups}
+    if self.shared_dir is not None:
+      index["shared_dir"] = os.path.relpath(self.shared_dir, self.dir_name)
+    # Written last, so a directory with an index is always complete
+    with open(os.path.join(self.dir_name, INDEX_FILE), 'w') as f:
+      json.dump(index, f)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.close()
+
+
+def _memmap(path, dtype, shape):
+  if not shape[0]: # np.memmap refuses empty files
+    return np.zeros(shape, dtype=dtype)
+  return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+
+class BinaryCorpus(object):
+  """Read-only view of a stage directory written by BinaryWriter.
+
+  corpus[doc_key] returns a dict of slices into the memory-mapped arrays;
+  nothing is read from disk until those slices are used. Groups the directory
+  doesn't hold itself come from its shared_dir.
+  """
+  def __init__(self, dir_name):
+    with open(os.path.join(dir_name, INDEX_FILE), 'r') as f:
+      index = json.load(f)
+    self.doc_keys = index["doc_keys"]
+    self.groups = index["groups"]
+    self.doc_key_to_index = {
+        doc_key: i for i, doc_key in enumerate(self.doc_keys)}
+    self.shared = None
+    if "shared_dir" in index:
+      self.shared = BinaryCorpus(
+          os.path.normpath(os.path.join(dir_name, index["shared_dir"])))
+      assert self.shared.doc_keys == self.doc_keys
+    self.offsets = np.fromfile(os.path.join(dir_name, OFFSETS_FILE),
+                               dtype=OFFSET_DTYPE).reshape(-1, len(self.groups))
+    self.arrays = {}
+    for group, num_entries in zip(self.groups, self.offsets[-1].tolist()):
+      for field in GROUP_FIELDS[group]:
+        shape = (num_entries, 2) if field in SPAN_FIELDS else (num_entries,)
+        self.arrays[field] = _memmap(
+            os.path.join(dir_name, field), span_lib.INDEX_DTYPE, shape)
+
+  def __len__(self):
+    return len(self.doc_keys)
+
+  def __contains__(self, doc_key):
+    return doc_key in self.doc_key_to_index
+
+  def __getitem__(self, doc_key):
+    i = self.doc_key_to_index[doc_key]
+    if self.shared is not None:
+      document = self.shared[doc_key]
+    else:
+      document = {"doc_key": doc_key}
+    starts, ends = self.offsets[i:i+2].tolist()
+    for group, start, end in zip(self.groups, starts, ends):
+      for field in GROUP_FIELDS[group]:
+        document[field] = self.arrays[field][start:end]
+    return document
+
+  def __iter__(self):
+    for doc_key in self.doc_keys:
+      yield self[doc_key]
@@ -0,0 +1,113 @@
+"""Content-hash cache that lets conversion reruns skip unchanged stages.
+
+Every stage is keyed by a hash of its input files, its parameters, the vocab
+file and the conversion code. A stage whose key matches the one recorded in
+the manifest, and whose outputs all still exist, is skipped.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import time
+
+MANIFEST_FILE = "manifest.json"
+HASH_BLOCK_SIZE = 1 << 20
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_PREFIX = "bench_" # Not part of the pipeline
+
+
+def code_version():
+  """Hash of the conversion code itself."""
+  digest = hashlib.sha1()
+  for filename in sorted(glob.glob(os.path.join(CODE_DIR, "*.py"))):
+    if os.path.basename(filename).startswith(BENCHMARK_PREFIX):
+      continue
+    digest.update(os.path.basename(filename).encode("utf-8"))
+    with open(filename, 'rb') as f:
+      digest.update(f.read())
+  return digest.hexdigest()
+
+
+def hash_file(filename):
+  """SHA-1 of a file's contents, read in blocks."""
+  digest = hashlib.sha1()
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+class BuildCache(object):
+  def __init__(self, cache_dir, vocab_file=None, rebuild=False):
+    self.cache_dir = cache_dir
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    self.manifest_file = os.path.join(cache_dir, MANIFEST_FILE)
+    if os.path.exists(self.manifest_file):
+      with open(self.manifest_file, 'r') as f:
+        self.manifest = json.load(f)
+    else:
+      self.manifest = {"stages": {}, "file_hashes": {}}
+    if rebuild: # Rerun everything, but still record the results
+      self.manifest["stages"] = {}
+    self.code_version = code_version()
+    self.vocab_hash = (self.file_hash(vocab_file)
+        if vocab_file is not None and os.path.exists(vocab_file) else vocab_file)
+
+  def file_hash(self, filename):
+    """Content hash, recomputed only when the file's size or mtime changes."""
+    stat = os.stat(filename)
+    known = self.manifest["file_hashes"].get(filename)
+    if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+      return known[2]
+    content_hash = hash_file(filename)
+    self.manifest["file_hashes"][filename] = [
+        stat.st_size, stat.st_mtime_ns, content_hash]
+    return content_hash
+
+  def stage_key(self, stage_name, inputs, params):
+    digest = hashlib.sha1()
+    digest.update(json.dumps(
+        [stage_name, sorted(params.items()), self.vocab_hash,
+         self.code_version]).encode("utf-8"))
+    for filename in inputs:
+      digest.update(filename.encode("utf-8"))
+      digest.update(self.file_hash(filename).encode("utf-8"))
+    return digest.hexdigest()
+
+  def is_fresh(self, stage_name, key, outputs):
+    recorded = self.manifest["stages"].get(stage_name)
+    return (recorded is not None and recorded["key"] == key
+            and all(os.path.exists(output) for output in outputs))
+
+  def record(self, stage_name, key, outputs, seconds):
+    self.manifest["stages"][stage_name] = {
+        "key": key, "outputs": outputs, "seconds": seconds}
+    self.save()
+
+  def save(self):
+    temp_file = self.manifest_file + ".tmp"
+    with open(temp_file, 'w') as f:
+      json.dump(self.manifest, f, indent=1)
+    os.replace(temp_file, self.manifest_file)
+
+  def run(self, stage_name, inputs, outputs, params, fn, *args):
+    key = self.stage_key(stage_name, inputs, params)
+    if self.is_fresh(stage_name, key, outputs):
+      print("Skipping unchanged stage {}".format(stage_name))
+      return
+    start_time = time.time()
+    fn(*args)
+    self.record(stage_name, key, outputs, time.time() - start_time)
+
+
+def run_stage(cache, stage_name, inputs, outputs, params, fn, *args):
+  """Run fn(*args) unless `cache` says its outputs are up to date.
+
+  With no cache, the stage always runs.
+  """
+  if cache is None:
+    fn(*args)
+  else:
+    cache.run(stage_name, inputs, outputs, params, fn, *args)
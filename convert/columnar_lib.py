@@ -0,0 +1,188 @@
+"""Columnar, whole-file view of a CoNLL dataset.
+
+The file is parsed once. Every per-token column is a flat int32 array over all
+tokens in the file, holding ids into an interned vocabulary for that column.
+Boundaries are offset arrays, in the style of CSR matrices:
+
+  doc_offsets       int64  (num_documents + 1,)  into sentences
+  sentence_offsets  int64  (num_sentences + 1,)  into tokens
+
+Coref mentions and constituents are span tables of corpus-wide token indices,
+so document- and sentence-relative positions are a subtraction away:
+
+  coref_spans       int32  (num_mentions, 2)
+  coref_clusters    int32  (num_mentions,)       ids into vocabs[COREF]
+  parse_spans       int32  (num_constituents, 2)
+  parse_labels      int32  (num_constituents,)   ids into vocabs[PARSE]
+
+Cluster labels are only unique within a document, so two mentions belong to
+the same cluster when both their document and their cluster id match.
+"""
+
+import numpy as np
+
+import conll_lib
+import span_lib
+
+OFFSET_DTYPE = np.int64
+
+LabelSequences = conll_lib.LabelSequences
+STRING_FIELDS = [
+    LabelSequences.WORD, LabelSequences.POS, LabelSequences.SPEAKER]
+
+
+class Vocab(object):
+  """Interns strings to consecutive ids."""
+  def __init__(self):
+    self.string_to_id = {}
+    self.strings = []
+
+  def add(self, string):
+    string_id = self.string_to_id.get(string)
+    if string_id is None:
+      string_id = len(self.strings)
+      self.string_to_id[string] = string_id
+      self.strings.append(string)
+    return string_id
+
+  def encode(self, strings):
+    strings = list(strings)
+    string_to_id = self.string_to_id
+    # A new string's id is the size of the vocab just before it was added
+    ids = [string_to_id.setdefault(string, len(string_to_id))
+           for string in strings]
+    if len(string_to_id) > len(self.strings):
+      for string, string_id in zip(strings, ids):
+        if string_id == len(self.strings):
+          self.strings.append(string)
+    return ids
+
+  def decode(self, ids):
+    return [self.strings[i] for i in np.asarray(ids).tolist()]
+
+  def get(self, string, default=-1):
+    return self.string_to_id.get(string, default)
+
+  def __len__(self):
+    return len(self.strings)
+
+
+def condense_parse_label(label):
+  """'(NP***)' -> 'NP'"""
+  return label.replace("*", "")[1:-1]
+
+
+class ColumnarCorpus(object):
+  def __init__(self, field_map=conll_lib.CONLL_FIELD_MAP):
+    self.fields = [field for field in STRING_FIELDS if field in field_map]
+    self.vocabs = {field: Vocab() for field in
+        self.fields + [LabelSequences.COREF, LabelSequences.PARSE]}
+    self.columns = {}
+    self.doc_ids = []
+    self.doc_parts = []
+    self.doc_offsets = None
+    self.sentence_offsets = None
+    self.coref_spans = None
+    self.coref_clusters = None
+    self.parse_spans = None
+    self.parse_labels = None
+
+  @classmethod
+  def from_conll(cls, filename, field_map=conll_lib.CONLL_FIELD_MAP):
+    return cls.from_documents(conll_lib.iter_conll_dataset(filename), field_map)
+
+  @classmethod
+  def from_documents(cls, documents, field_map=conll_lib.CONLL_FIELD_MAP):
+    """From listified documents, as conll_lib.iter_conll_dataset yields them."""
+    corpus = cls(field_map)
+    # Strings are collected for the whole corpus, then interned in one go
+    columns = {field: [] for field in corpus.fields}
+    doc_offsets = [0]
+    sentence_offsets = [0]
+    coref_spans, coref_clusters = [], []
+    parse_spans, parse_labels = [], []
+    coref_vocab = corpus.vocabs[LabelSequences.COREF]
+
+    for document in documents:
+      begin_line = document[0][0]
+      assert begin_line[0] == "#begin"
+      corpus.doc_ids.append(begin_line[2][1:-2])
+      corpus.doc_parts.append(int(begin_line[-1]))
+      for sentence in document[1:-1]:
+        offset = sentence_offsets[-1]
+        sequences, coref_map, parse_map = conll_lib.parse_sentence(
+            sentence, offset, field_map)
+        for field in corpus.fields:
+          columns[field] += sequences[field]
+        for cluster, spans in coref_map.items():
+          coref_spans += spans
+          coref_clusters += [coref_vocab.add(cluster)] * len(spans)
+        parse_spans += parse_map.keys()
+        parse_labels += parse_map.values()
+        sentence_offsets.append(offset + len(sentence))
+      doc_offsets.append(len(sentence_offsets) - 1)
+
+    for field, strings in columns.items():
+      corpus.columns[field] = np.asarray(corpus.vocabs[field].encode(strings),
+                                         dtype=span_lib.INDEX_DTYPE)
+    corpus.doc_parts = np.asarray(corpus.doc_parts, dtype=span_lib.INDEX_DTYPE)
+    corpus.doc_offsets = np.asarray(doc_offsets, dtype=OFFSET_DTYPE)
+    corpus.sentence_offsets = np.asarray(sentence_offsets, dtype=OFFSET_DTYPE)
+    corpus.coref_spans = span_lib.span_array(coref_spans)
+    corpus.coref_clusters = np.asarray(coref_clusters,
+                                       dtype=span_lib.INDEX_DTYPE)
+    corpus.parse_spans = span_lib.span_array(parse_spans)
+    # Labels still have their stars; only the distinct ones are condensed
+    label_vocab = Vocab()
+    label_ids = np.asarray(label_vocab.encode(parse_labels),
+                           dtype=span_lib.INDEX_DTYPE)
+    parse_vocab = corpus.vocabs[LabelSequences.PARSE]
+    condensed_ids = np.asarray(
+        parse_vocab.encode(map(condense_parse_label, label_vocab.strings)),
+        dtype=span_lib.INDEX_DTYPE)
+    corpus.parse_labels = condensed_ids[label_ids]
+    return corpus
+
+  @property
+  def num_documents(self):
+    return len(self.doc_ids)
+
+  @property
+  def num_sentences(self):
+    return len(self.sentence_offsets) - 1
+
+  @property
+  def num_tokens(self):
+    return int(self.sentence_offsets[-1])
+
+  @property
+  def doc_token_offsets(self):
+    """Token offsets of each document, shape (num_documents + 1,)."""
+    return self.sentence_offsets[self.doc_offsets]
+
+  def token_sentence_ids(self):
+    """Sentence index of every token."""
+    return np.repeat(np.arange(self.num_sentences, dtype=span_lib.INDEX_DTYPE),
+                     np.diff(self.sentence_offsets))
+
+  def token_doc_ids(self):
+    """Document index of every token."""
+    return np.repeat(np.arange(self.num_documents, dtype=span_lib.INDEX_DTYPE),
+                     np.diff(self.doc_token_offsets))
+
+  def span_doc_ids(self, spans):
+    return np.searchsorted(
+        self.doc_token_offsets, spans[:, 0], side='right').astype(
+            span_lib.INDEX_DTYPE) - 1
+
+  def span_sentence_ids(self, spans):
+    return np.searchsorted(
+        self.sentence_offsets, spans[:, 0], side='right').astype(
+            span_lib.INDEX_DTYPE) - 1
+
+  def column_strings(self, field, start=0, end=None):
+    return self.vocabs[field].decode(self.columns[field][start:end])
+
+  def sentence(self, sentence_index, field=LabelSequences.WORD):
+    start, end = self.sentence_offsets[sentence_index:sentence_index + 2]
+    return self.column_strings(field, start, end)
@@ -1,3 +1,6 @@
+import collections
+import functools
+
 import conll_lib
 import convert_lib
 
@@ -5,45 +8,83 @@ import re
 
 NP_REGEX = r"\(NP\**\)"
 
-def get_token_spans(parse_map):
-  janky_token_indices = set(sum((list(i) for i in parse_map.keys()), []))
-  return [(i, i) for i in janky_token_indices]
+
+class SpanCategory(object):
+  COREFERENT = "COREFERENT"
+  CONSTITUENT = "CONSTITUENT"
+  TOKEN = "TOKEN" # Single tokens at either end of a constituent
+  NP = "NP"
+
+# Categories assigned by matching the constituent's label
+LABEL_CATEGORY_REGEXES = collections.OrderedDict([
+  (SpanCategory.NP, re.compile(NP_REGEX)),
+])
+
+
+@functools.lru_cache(maxsize=None)
+def classify_label(label):
+  """Label categories of a constituent label; matched once per distinct label."""
+  return tuple(category for category, regex in LABEL_CATEGORY_REGEXES.items()
+               if regex.match(label))
+
+
+class SpanIndex(object):
+  """Spans of one document by category, filled in a sentence at a time.
+
+  Unions of categories are cached, so variants sharing categories don't
+  recompute them.
+  """
+  def __init__(self):
+    self.spans = collections.defaultdict(set)
+    self._unions = {}
+
+  def add_sentence(self, coref_map, parse_map):
+    """Maps as returned by conll_lib.parse_sentence, with document offsets."""
+    coreferent = self.spans[SpanCategory.COREFERENT]
+    for spans in coref_map.values():
+      coreferent.update(spans)
+    constituents = self.spans[SpanCategory.CONSTITUENT]
+    tokens = self.spans[SpanCategory.TOKEN]
+    for span, label in parse_map.items():
+      constituents.add(span)
+      tokens.add((span[0], span[0]))
+      tokens.add((span[1], span[1]))
+      for category in classify_label(label):
+        self.spans[category].add(span)
+    self._unions = {}
+
+  def union(self, categories):
+    key = tuple(sorted(categories))
+    if key not in self._unions:
+      self._unions[key] = set().union(
+          *(self.spans[category] for category in key))
+    return self._unions[key]
+
 
 # Begin alternate conll functions
+# Each candidate generator maps a document's SpanIndex to its set of mentions.
 
-def get_classic_sent(unused_coref_map, unused_parse_map, unused_pos):
-  return set()
-
-def get_gold_sent(coref_map, unused_parse_map, unused_pos):
-  return set(sum(coref_map.values(), []))
-
-def get_goldconst_sent(unused_coref_map, parse_map, unused_pos):
-  token_spans = get_token_spans(parse_map)
-  return set(parse_map.keys()).union(set(token_spans))
-
-def get_sing_sent(coref_map, parse_map, pos):
-  coreferent_spans = set(sum(coref_map.values(), []))
-  token_spans = get_token_spans(parse_map)
-  parse_markables = [span
-                        for span, label in parse_map.items()
-                        if re.match(NP_REGEX, label)]
-  return set(
-             parse_markables).union(
-             coreferent_spans).union(set(token_spans))
-
-def get_npsing_sent(coref_map, parse_map, unused_pos):
-  coreferent_spans = set(sum(coref_map.values(), []))
-  parse_markables = [span
-                        for span, label in parse_map.items()
-                        if re.match(NP_REGEX, label)]
-  return set(parse_markables).union(coreferent_spans)
-
-FN_MAP = {
-  convert_lib.Variation.classic: get_classic_sent,
-  convert_lib.Variation.sing: get_sing_sent,
-  convert_lib.Variation.gold: get_gold_sent,
-  convert_lib.Variation.goldconst: get_goldconst_sent,
-  }
+FN_MAP = collections.OrderedDict()
+
+def register_candidates(variation, fn):
+  FN_MAP[variation] = fn
+  return fn
+
+
+def span_union(*categories):
+  """Candidate generator returning every span in any of `categories`."""
+  return lambda span_index: span_index.union(categories)
+
+
+register_candidates(convert_lib.Variation.classic, span_union())
+register_candidates(convert_lib.Variation.sing, span_union(
+    SpanCategory.NP, SpanCategory.COREFERENT, SpanCategory.TOKEN))
+register_candidates(convert_lib.Variation.gold, span_union(
+    SpanCategory.COREFERENT))
+register_candidates(convert_lib.Variation.goldconst, span_union(
+    SpanCategory.CONSTITUENT, SpanCategory.TOKEN))
+register_candidates(convert_lib.Variation.npsing, span_union(
+    SpanCategory.NP, SpanCategory.COREFERENT))
 
 # End alternate conll functions
 
@@ -56,47 +97,38 @@ def get_pos_markables(pos_sequence, markable_list):
   return pos_markables
 
 
-def conll_add_singletons(dataset, fn):
-  """
-    Args:
-      dataset: listified dataset
-  """
-  new_dataset = []
-  for document in dataset:
-    new_dataset.append(doc_apply_labels(document, get_doc_labels(document, fn))) 
-  return new_dataset
-
-
 def create_additional_labels(new_mentions, cluster_offset, doc_len):
-  labels = ["" for _ in range(doc_len)]
-  for i , (start, end) in enumerate(sorted(new_mentions)):
-    cluster_id = "s" + str(i + cluster_offset)
-    if labels[start]:
-      labels[start] += "|"
+  labels = [""] * doc_len
+  for i, (start, end) in enumerate(sorted(new_mentions), cluster_offset):
+    cluster_id = "s" + str(i)
     if start == end:
-      labels[start] += "({0})".format(cluster_id)
+      label = "(" + cluster_id + ")"
+      labels[start] = labels[start] + "|" + label if labels[start] else label
     else:
-      labels[start] += "({0}".format(cluster_id)
-      if labels[end]:
-        labels[end] += "|"
-      labels[end] += "{0})".format(cluster_id)
+      label = "(" + cluster_id
+      labels[start] = labels[start] + "|" + label if labels[start] else label
+      label = cluster_id + ")"
+      labels[end] = labels[end] + "|" + label if labels[end] else label
   return labels
 
-def get_doc_labels(document, sentence_fn):
+def get_doc_labels_multi(document, candidate_fns):
+  """get_doc_labels for several candidate generators, parsing the document once.
+
+    Args:
+      candidate_fns: dict of variant name to candidate generator
+
+    Returns:
+      dict of variant name to that variant's labels
+  """
  
-  new_mentions = set()
+  span_index = SpanIndex()
   sentence_offset = 0
   mention_start_index = 0
   
   for sent in document[1:-1]:
-    sequences = conll_lib.get_sequences(sent)
-    coref_map = conll_lib.build_coref_span_map(
-                    sequences["COREF"], sentence_offset)
-    parse_map = conll_lib.build_parse_span_map(
-                    sequences["PARSE"], sentence_offset)
-  
-    additional_mentions = sentence_fn(coref_map, parse_map, sequences["POS"])
-    new_mentions.update(additional_mentions)
+    sequences, coref_map, parse_map = conll_lib.parse_sentence(
+        sent, sentence_offset)
+    span_index.add_sentence(coref_map, parse_map)
     sentence_offset += len(sequences["WORD"])
     maybe_mention_start_index = max(list(
       int(i) for i in coref_map.keys()) + [0]) + 1
@@ -104,33 +136,75 @@ def get_doc_labels(document, sentence_fn):
 
   doc_len = sentence_offset
 
-  return create_additional_labels(new_mentions,
-      mention_start_index, doc_len)
+  return {name: create_additional_labels(
+              candidate_fn(span_index), mention_start_index, doc_len)
+          for name, candidate_fn in candidate_fns.items()}
+
+
+COREF_IDX = conll_lib.CONLL_FIELD_MAP[conll_lib.LabelSequences.COREF]
+
+def merge_coref_label(curr_coref_label, label):
+  if not label:
+    return curr_coref_label
+  elif curr_coref_label == "-":
+    return label
+  else:
+    return curr_coref_label + "|" + label
+
 
+def iter_labelled_sentences(document, labels):
+  """Yields the sentences of `document` with `labels` merged into the coref
+  column, one label per token in document order.
 
-def doc_apply_labels(document, labels):
-  coref_idx = conll_lib.CONLL_FIELD_MAP[conll_lib.LabelSequences.COREF]
+  The input is left untouched: rows that get a label are copied, the rest are
+  shared with `document`.
+  """
+  token_idx = 0
   for sent in document[1:-1]:
-    for i, word in enumerate(sent):
-      curr_coref_label = word[coref_idx]
-      label = labels.pop(0)
-      if not label:
-        continue
-      else:
-        if curr_coref_label == "-":
-          sent[i][coref_idx] = label
-        else:
-          sent[i][coref_idx] += "|" + label
-  return document
-
-def write_conll_to_file(conll_list_dataset, output_filename):
-  with open(output_filename, 'w') as f:
-    for document in conll_list_dataset:
-      for sentence in document:
-        if sentence[0][0].startswith("#"):
-          assert len(sentence) == 1
-          f.write("\t".join(sentence[0]) + "\n")
-        else:
-          f.write("\n".join("\t".join(word) for word in sentence))
-          f.write("\n\n")
-     
+    new_sent = []
+    for word in sent:
+      label = labels[token_idx]
+      token_idx += 1
+      if label:
+        word = list(word)
+        word[COREF_IDX] = merge_coref_label(word[COREF_IDX], label)
+      new_sent.append(word)
+    yield new_sent
+  assert token_idx == len(labels)
+
+
+def sentence_to_text(sentence):
+  if sentence[0][0].startswith("#"):
+    assert len(sentence) == 1
+    return "\t".join(sentence[0]) + "\n"
+  else:
+    # One write per sentence rather than per field
+    return "".join("\t".join(word) + "\n" for word in sentence) + "\n"
+
+
+def write_conll_variants(dataset, candidate_fns, output_filenames):
+  """Writes every variant of `dataset` in one pass, parsing each document once.
+
+  Merged coref labels go straight to the output streams; no labelled copy of
+  a document is built.
+
+    Args:
+      candidate_fns: dict of variant name to candidate generator
+      output_filenames: dict of variant name to output file
+  """
+  files = {name: open(output_filenames[name], 'w',
+                    buffering=convert_lib.CONLL_BUFFER_SIZE)
+           for name in candidate_fns}
+  try:
+    for document in dataset:
+      header = sentence_to_text(document[0])
+      footer = sentence_to_text(document[-1])
+      for name, labels in get_doc_labels_multi(document, candidate_fns).items():
+        f = files[name]
+        f.write(header)
+        for sentence in iter_labelled_sentences(document, labels):
+          f.write(sentence_to_text(sentence))
+        f.write(footer)
+  finally:
+    for f in files.values():
+      f.close()
@@ -5,21 +5,19 @@ import os
 import conll_alternates
 import conll_lib
 import convert_lib
+import schedule_lib
 
 
 def add_sentence(curr_doc, curr_sent, doc_coref_map, doc_parse_map,
                  sentence_offset):
-  sequences = conll_lib.get_sequences(curr_sent, conll_lib.CONLL_FIELD_MAP)
+  sequences, coref_span_map, parse_span_map = conll_lib.parse_sentence(
+      curr_sent, sentence_offset, conll_lib.CONLL_FIELD_MAP)
   curr_doc.speakers.append(sequences[conll_lib.LabelSequences.SPEAKER])
   curr_doc.sentences.append(sequences[conll_lib.LabelSequences.WORD])
   #curr_doc.pos.append(sequences[conll_lib.LabelSequences.POS])
 
-  coref_span_map = conll_lib.build_coref_span_map(
-      sequences[conll_lib.LabelSequences.COREF], sentence_offset)
   doc_coref_map = conll_lib.ldd_append(doc_coref_map, coref_span_map)
 
-  parse_span_map = conll_lib.build_parse_span_map(
-      sequences[conll_lib.LabelSequences.PARSE], sentence_offset)
   doc_parse_map = conll_lib.ldd_append(doc_parse_map, parse_span_map)
   
   sentence_offset += len(sequences[conll_lib.LabelSequences.WORD])
@@ -27,15 +25,10 @@ def add_sentence(curr_doc, curr_sent, doc_coref_map, doc_parse_map,
   return doc_coref_map, doc_parse_map, sentence_offset#, sequences["POS"]
 
 
-def create_dataset(filename, dataset_name):
- 
-  dataset = convert_lib.Dataset(dataset_name)
+def iter_documents(filename):
+  """Yield TOKENIZED CorefDocuments from a CoNLL file, one at a time."""
 
-  list_data = conll_lib.listify_conll_dataset(filename)
-
-  document_counter = 0
-
-  for doc in list_data:
+  for doc in conll_lib.iter_conll_dataset(filename):
     sentence_offset = 0
     doc_coref_map = collections.defaultdict(list)
     doc_parse_map = collections.defaultdict(list)
@@ -65,51 +58,140 @@ def create_dataset(filename, dataset_name):
     other_info = {"parse_map": [(k, v) for k, v in doc_coref_map.items()]}
     curr_doc.other_info_json = json.dumps(other_info)
   
-    curr_doc.clusters = true_clusters
+    curr_doc.set_mentions(true_clusters)
     curr_doc.additional_mentions = additional_mentions
-    dataset.documents[convert_lib.ProcessingStage.TOKENIZED].append(curr_doc)
+    yield curr_doc
 
-  if dataset_name == "classic":
-    dataset.dump_to_conll(filename.replace(".txt", ".conll"),
-                          drop_singletons=True)
-    
-  return dataset
 
-def create_alternate_subdataset(data_home, original_dataset, new_dataset):
+def create_alternate_splits(input_filename, output_filenames):
+  """All variants in `output_filenames` from one read of the input."""
+  dataset = conll_lib.iter_conll_dataset(input_filename)
+  candidate_fns = collections.OrderedDict(
+      (new_dataset, conll_alternates.FN_MAP[new_dataset])
+      for new_dataset in output_filenames)
+  conll_alternates.write_conll_variants(
+      dataset, candidate_fns, output_filenames)
+
+
+def add_alternate_jobs(graph, data_home, original_dataset, new_datasets):
+  """Adds one create_alternate_splits job per split.
+
+  Returns an OrderedDict from split to job name.
+  """
   input_directory = os.path.join(
       data_home, "original", original_dataset)
-  output_directory = os.path.join(data_home, "original/conll_alternates", new_dataset)
-  convert_lib.create_dir(output_directory)
-    
-  fn = conll_alternates.FN_MAP[new_dataset]
-
+  output_directories = collections.OrderedDict(
+      (new_dataset, os.path.join(
+          data_home, "original/conll_alternates", new_dataset))
+      for new_dataset in new_datasets)
+  for output_directory in output_directories.values():
+    convert_lib.create_dir(output_directory)
+
+  jobs = collections.OrderedDict()
   for split in convert_lib.DatasetSplit.ALL:
     input_filename = os.path.join(input_directory, split + ".txt")
-    output_filename = os.path.join(
-                          output_directory, split + ".txt")
-    dataset = conll_lib.listify_conll_dataset(input_filename)
-    converted_dataset = conll_alternates.conll_add_singletons(dataset, fn)
-    conll_alternates.write_conll_to_file(converted_dataset, output_filename) 
-
-
-def convert_subdataset(data_home, dataset_name):
-  input_directory = os.path.join(data_home, "original/conll_alternates", dataset_name)
-  output_directory = os.path.join(data_home, "processed/conll", dataset_name)
-  convert_lib.create_dir(output_directory)
-  conll_datasets = {}
-  for split in convert_lib.DatasetSplit.ALL:
-    input_filename = os.path.join(input_directory, split + ".txt")
-    converted_dataset = create_dataset(input_filename, dataset_name)
-    convert_lib.write_converted(converted_dataset, output_directory + "/" + split)
- 
+    output_filenames = collections.OrderedDict(
+        (new_dataset, os.path.join(output_directory, split + ".txt"))
+        for new_dataset, output_directory in output_directories.items())
+    jobs[split] = graph.add(
+        "/".join(
+            [original_dataset, "alternate", "+".join(new_datasets), split]),
+        create_alternate_splits, [input_filename, output_filenames],
+        inputs=[input_filename], outputs=list(output_filenames.values()))
+  return jobs
+
+
+def iter_variant_documents(input_filenames):
+  """Zips iter_documents over the same split of several variants.
+
+    Args:
+      input_filenames: OrderedDict from variant to its CoNLL file
+
+    Yields:
+      OrderedDicts from variant to TOKENIZED document
+  """
+  document_iterators = []
+  for dataset_name, input_filename in input_filenames.items():
+    documents = iter_documents(input_filename)
+    if dataset_name == "classic":
+      documents = convert_lib.tee_to_conll(
+          documents, input_filename.replace(".txt", ".conll"),
+          drop_singletons_values=[True])
+    document_iterators.append(documents)
+  for documents in zip(*document_iterators):
+    assert convert_lib.all_same(
+        (document.doc_id, document.doc_part) for document in documents)
+    yield collections.OrderedDict(zip(input_filenames.keys(), documents))
+
+
+def convert_split_variants(input_filenames, output_prefixes, num_workers=1,
+                           binary=False):
+  """Converts one split of several variants, tokenizing and segmenting once."""
+  convert_lib.stream_variants_converted(
+      iter_variant_documents(input_filenames), output_prefixes,
+      num_workers=num_workers, binary=binary)
+
+
+def convert_split_outputs(input_filename, output_prefix, dataset_name,
+                          binary=False):
+  outputs = convert_lib.converted_file_names(output_prefix, binary=binary)
+  if dataset_name == "classic":
+    outputs.append(convert_lib.conll_file_name(
+        input_filename.replace(".txt", ".conll"), True))
+  return outputs
 
-def convert(data_home):
+
+def add_convert_jobs(graph, data_home, dataset_names, num_workers=1,
+                     binary=False, deps=None):
+  """Adds one convert_split_variants job per split.
+
+  `deps` optionally maps each split to the jobs it has to wait for.
+  """
+  input_directory = os.path.join(data_home, "original/conll_alternates")
+  output_directory = os.path.join(data_home, "processed/conll")
+  for dataset_name in dataset_names:
+    convert_lib.create_dir(os.path.join(output_directory, dataset_name))
+  for split in convert_lib.DatasetSplit.ALL:
+    input_filenames = collections.OrderedDict(
+        (dataset_name, os.path.join(
+            input_directory, dataset_name, split + ".txt"))
+        for dataset_name in dataset_names)
+    output_prefixes = collections.OrderedDict(
+        (dataset_name, os.path.join(output_directory, dataset_name, split))
+        for dataset_name in dataset_names)
+    outputs = sum([convert_split_outputs(input_filenames[dataset_name],
+                                         output_prefixes[dataset_name],
+                                         dataset_name, binary)
+                   for dataset_name in dataset_names], [])
+    graph.add(
+        "/".join([convert_lib.DatasetName.conll, "convert",
+                  "+".join(dataset_names), split]),
+        convert_split_variants,
+        [input_filenames, output_prefixes, num_workers, binary],
+        deps=(deps or {}).get(split, ()),
+        inputs=list(input_filenames.values()), outputs=outputs,
+        params={"binary": binary})
+
+
+ALTERNATE_SUBDATASETS = [convert_lib.Variation.classic,
+  convert_lib.Variation.sing, convert_lib.Variation.gold,
+  convert_lib.Variation.goldconst]
+
+
+def add_jobs(graph, data_home, num_workers=1, binary=False):
+  """Every job of `convert`; each split's conversion waits for its alternates."""
+  # Every variant is labelled from a single parse of each original split
+  alternate_jobs = add_alternate_jobs(
+      graph, data_home, convert_lib.DatasetName.conll, ALTERNATE_SUBDATASETS)
+  # The variants differ only in their mentions, so they are BPE-tokenized and
+  # segmented together
+  add_convert_jobs(
+      graph, data_home, ALTERNATE_SUBDATASETS, num_workers, binary,
+      deps={split: [job] for split, job in alternate_jobs.items()})
+
+
+def convert(data_home, num_workers=1, binary=False, cache=None, num_jobs=1):
   """This just creates the alternate conlls, then converts everything."""
-  alternate_subdatasets = [convert_lib.Variation.classic,
-    convert_lib.Variation.sing, convert_lib.Variation.gold,
-    convert_lib.Variation.goldconst]
-
-  for subdataset in alternate_subdatasets:
-    create_alternate_subdataset(
-        data_home, convert_lib.DatasetName.conll, subdataset)
-    convert_subdataset(data_home, subdataset)
+  graph = schedule_lib.JobGraph()
+  add_jobs(graph, data_home, num_workers, binary)
+  graph.run(num_jobs, cache)
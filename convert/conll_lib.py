@@ -1,4 +1,9 @@
 import collections
+import json
+import mmap
+import operator
+import os
+import re
 
 
 class LabelSequences(object):
@@ -29,107 +34,243 @@ def get_index(list_of_lists, index):
   return [record[index] for record in list_of_lists]
 
 def get_sequences(sentence, field_map=CONLL_FIELD_MAP):
-  sequences = {}
-  for field, index in field_map.items():
-    sequences[field] = get_index(sentence, index)
-  return sequences
+  return parse_sentence(sentence, 0, field_map)[0]
 
 
-def listify_conll_dataset(filename):
+def iter_conll_lines(lines):
+  """Yield one listified document at a time from an iterable of lines."""
 
-  dataset = []
- 
   curr_doc = []
   curr_sent = []
 
+  for line in lines:
+    fields = line.split()
+
+    if line.startswith("#begin"):
+      assert not curr_doc 
+      curr_doc.append([fields])
+    
+    elif line.startswith("#end"):
+      curr_doc.append([fields])
+      yield curr_doc
+      curr_doc = []
+    
+    elif not line.strip():
+      if curr_sent:
+        curr_doc.append(curr_sent)
+        curr_sent = []
+        
+    else: # Empty line signifies the end of a sentence
+      curr_sent.append(fields)
+
 
+def iter_conll_dataset(filename):
+  """Yield one listified document at a time; same structure as listify."""
   with open(filename, 'r') as f:
+    yield from iter_conll_lines(f)
+
+
+def listify_conll_dataset(filename):
+  return list(iter_conll_dataset(filename))
+
+
+DOC_INDEX_SUFFIX = ".docindex.json"
+
+def doc_key_from_begin_line(line):
+  """'#begin document (bc/cnn/00/cnn_0000); part 000' -> (doc_id, part)"""
+  fields = line.split()
+  return fields[2][1:-2], int(fields[-1])
+
+
+def build_doc_index(filename):
+  """[doc_id, part, start byte, end byte] for each document, in one scan."""
+  entries = []
+  offset = 0
+  with open(filename, 'rb') as f:
     for line in f:
-      fields = line.split()
-
-      if line.startswith("#begin"):
-        assert not curr_doc 
-        curr_doc.append([fields])
-      
-      elif line.startswith("#end"):
-        curr_doc.append([fields])
-        dataset.append(curr_doc)
-        curr_doc = []
-      
-      elif not line.strip():
-        if curr_sent:
-          curr_doc.append(curr_sent)
-          curr_sent = []
-          
-      else: # Empty line signifies the end of a sentence
-        curr_sent.append(fields)
-
-  return dataset
+      if line.startswith(b"#begin"):
+        doc_id, part = doc_key_from_begin_line(line.decode("utf-8"))
+        start = offset
+      elif line.startswith(b"#end"):
+        entries.append([doc_id, part, start, offset + len(line)])
+      offset += len(line)
+  return entries
 
 
-def build_coref_span_map(coref_col, offset=0):
+# Sidecars are json files next to a data file, holding something computed
+# from it, e.g. the document index. They are tagged with the data file's size
+# and mtime, and count as stale once either moves.
+
+def read_sidecar(filename, suffix):
+  """What write_sidecar saved for filename, or None if stale or missing."""
+  stat = os.stat(filename)
+  sidecar_file = filename + suffix
+  if os.path.exists(sidecar_file):
+    with open(sidecar_file, 'r') as f:
+      saved = json.load(f)
+    if [saved["size"], saved["mtime_ns"]] == [stat.st_size, stat.st_mtime_ns]:
+      return saved.get("contents")
+  return None
+
+
+def write_sidecar(filename, suffix, contents, stat):
+  """Saves contents for filename; stat is its os.stat from before computing."""
+  sidecar_file = filename + suffix
+  try:
+    temp_file = sidecar_file + ".tmp"
+    with open(temp_file, 'w') as f:
+      json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                 "contents": contents}, f)
+    os.replace(temp_file, sidecar_file)
+  except OSError: # Read-only data directory; just don't keep it
+    pass
+
+
+def load_doc_index(filename):
+  """Read the sidecar index, rebuilding it if the file's size or mtime moved."""
+  stat = os.stat(filename)
+  entries = read_sidecar(filename, DOC_INDEX_SUFFIX)
+  if entries is None:
+    entries = build_doc_index(filename)
+    write_sidecar(filename, DOC_INDEX_SUFFIX, entries, stat)
+  return entries
+
+
+class ConllDocumentReader(object):
+  """Random access to the documents of a CoNLL file by (doc_id, part).
+
+  The file is memory-mapped and only the requested documents are parsed, into
+  the same listified structure as iter_conll_dataset.
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.ranges = collections.OrderedDict(
+        ((doc_id, part), (start, end))
+        for doc_id, part, start, end in load_doc_index(filename))
+    self.file = open(filename, 'rb')
+    self.mmap = (mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                 if self.ranges else b"")
+
+  def keys(self):
+    return list(self.ranges.keys())
+
+  def __len__(self):
+    return len(self.ranges)
+
+  def __contains__(self, doc_key):
+    return doc_key in self.ranges
+
+  def __getitem__(self, doc_key):
+    doc_id, part = doc_key
+    start, end = self.ranges[(doc_id, int(part))]
+    text = self.mmap[start:end].decode("utf-8")
+    documents = list(iter_conll_lines(text.splitlines(True)))
+    assert len(documents) == 1
+    return documents[0]
+
+  def iter_documents(self, doc_keys=None):
+    for doc_key in (self.keys() if doc_keys is None else doc_keys):
+      yield self[doc_key]
+
+  def shard(self, shard_index, num_shards):
+    """Doc keys of one contiguous shard, for splitting work across processes."""
+    keys = self.keys()
+    shard_size = -(-len(keys) // num_shards)
+    return keys[shard_index * shard_size:(shard_index + 1) * shard_size]
+
+  def close(self):
+    if self.ranges:
+      self.mmap.close()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.close()
+
+
+# A chunk is everything up to a paren
+PARSE_CHUNK_RE = re.compile(r"^[^()]+|[()][^()]*")
+
+def parse_sentence(sentence, offset=0, field_map=CONLL_FIELD_MAP):
+  """Columns, coref spans and constituents of a sentence, in one pass.
+
+  A single walk over the rows picks out every field of field_map and builds
+  both span maps; offset is the token offset of the sentence within the
+  document. Returns (sequences, coref_span_map, parse_span_map). Without a
+  COREF or PARSE field, that map is empty.
+  """
+  fields = list(field_map)
+  get_fields = operator.itemgetter(*field_map.values())
+  coref_index = field_map.get(LabelSequences.COREF)
+  parse_index = field_map.get(LabelSequences.PARSE)
+
+  rows = []
   span_starts = collections.defaultdict(list)
-  complete_spans = []
-  for i, orig_label in enumerate(coref_col):
-    if orig_label == '-': # no coref label
-      continue
-    else:
-      labels = orig_label.split("|") # split for multiple (nested) case
-      for label in labels:
-        if label.startswith("("): # Span start
+  coref_map = collections.defaultdict(list)
+  stack = [] # Top of the stack is the end of the list
+  parse_map = {}
+  for i, row in enumerate(sentence, offset): # i is the document token index
+    rows.append(get_fields(row))
+
+    if coref_index is not None and row[coref_index] != '-':
+      for label in row[coref_index].split("|"): # Multiple (nested) mentions
+        if label.startswith("("):
           if label.endswith(")"): # Single-token span
-            complete_spans.append((i, i, label[1:-1]))
+            coref_map[label[1:-1]].append((i, i))
           else:
             span_starts[label[1:]].append(i) # Register span start for later
         elif label.endswith(")"):
-          ending_cluster = label[:-1] # Which cluster is ending here
+          ending_cluster = label[:-1]
+          # Sometimes it's closing a nested span but apparently never more
+          # than two levels for the same entity
           assert len(span_starts[ending_cluster]) in [1, 2]
-          # Sometimes it's closing a nested span but apparently never more than
-          # two levels for the same entity
-          start_idx = span_starts[ending_cluster].pop(-1)
           # The one added latest is the match
-          complete_spans.append((start_idx, i, ending_cluster))
+          coref_map[ending_cluster].append(
+              (span_starts[ending_cluster].pop(), i))
 
-  span_dict = collections.defaultdict(list)
-  for start, end, cluster in complete_spans:
-    span_dict[cluster].append((offset + start, offset + end))
-    # offset is the token offset of the sentence within the document
-  return span_dict
+    if parse_index is None:
+      continue
+    parse_label = row[parse_index]
+    if parse_label == "*": # By far the most common label
+      stack[-1][0] += parse_label
+      continue
+    opens, star, closes = parse_label.partition("*")
+    if (star and opens[:1] in ("", "(") and ")" not in opens
+        and closes == ")" * len(closes)): # The usual shape, e.g. "(S(NP*))"
+      for name in opens.split("(")[1:]:
+        stack.append(["(" + name, i])
+      stack[-1][0] += star
+      for _ in closes:
+        span_prefix, start_idx = stack.pop()
+        parse_map[(start_idx, i)] = span_prefix + ")"
+      continue
+    for label in PARSE_CHUNK_RE.findall(parse_label): # Chunking around parens
+      if label[0] == "(": # Register start of a label
+        stack.append([label, i])
+      elif label[-1] == ")": # End of chunk; the label is the suffix
+        span_prefix, start_idx = stack.pop()
+        parse_map[(start_idx, i)] = span_prefix + label
+      else:
+        stack[-1][0] += label # Part of the label we're currently collecting
+
+  if len(fields) == 1: # itemgetter of one index gives the value itself
+    columns = [rows]
+  else:
+    columns = [list(column) for column in zip(*rows)] or [[] for _ in fields]
+  return dict(zip(fields, columns)), coref_map, parse_map
 
 
-def split_parse_label(label):
-  curr_chunk = ""
-  chunks = []
-  for c in label:
-    if c in "()": # A chunk is everything up to a paren
-      if curr_chunk:
-        chunks.append(curr_chunk)
-      curr_chunk = c
-    else:
-      curr_chunk += c
-  chunks.append(curr_chunk)
-  return chunks
+def build_coref_span_map(coref_col, offset=0):
+  return parse_sentence([[label] for label in coref_col], offset,
+                        {LabelSequences.COREF: 0})[1]
 
 
 def build_parse_span_map(parse_col, offset=0):
-  span_starts = collections.defaultdict(list)
-  stack = []
-  label_map = {}
-  for i, orig_label in enumerate(parse_col):
-    labels = split_parse_label(orig_label) # Chunking around parens
-    for label in labels:
-      if label.startswith("("): # Register start of a label
-        stack.insert(0, [label, i + offset]) # Goes on the top of the stack
-        # ^ build up label in [0], remember start (with offset) in [1]
-      elif label.endswith(")"): # End of chunk, hopefully start was registered
-        span_prefix, start_idx = stack.pop(0)
-        assert (span_prefix, i) not in label_map # This is an unclosed span
-        label_map[
-            (start_idx, i + offset)] = span_prefix + label # Label is suffix
-      else:
-        stack[0][0] += label # This is part of the label we're currently collecting
+  return parse_sentence([[label] for label in parse_col], offset,
+                        {LabelSequences.PARSE: 0})[2]
 
-  return label_map
 
 def ldd_append(ldd, to_append):
   for k, v in to_append.items():
@@ -1,12 +1,59 @@
-import sys
+import argparse
+import os
+
+import build_cache
 import preco_converter
 import conll_converter
+import convert_lib
+import schedule_lib
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(
+      description="Convert PreCo and CoNLL-12 into all processed formats.")
+  parser.add_argument("data_home")
+  parser.add_argument("--token_cache_file", default=None,
+                      help="Keeps tokenizer results between runs.")
+  parser.add_argument("--vocab_file", default=None,
+                      help="BERT vocab; defaults to $MENTION_BOTTLENECK_VOCAB.")
+  parser.add_argument("--num_workers", type=int, default=1,
+                      help="Processes used to BPE-tokenize and segment.")
+  parser.add_argument("--num_jobs", type=int, default=1,
+                      help="Conversion stages (dataset, variant, split) run "
+                           "at once, each with its own --num_workers.")
+  parser.add_argument("--binary", action="store_true",
+                      help="Also write memory-mappable binary segments.")
+  parser.add_argument("--rebuild", action="store_true",
+                      help="Ignore the build cache and rerun every stage.")
+  return parser.parse_args()
 
 
 def main():
-  data_home = sys.argv[1]
-  preco_converter.convert(data_home) 
-  conll_converter.convert(data_home) 
+  args = parse_args()
+  convert_lib.TOKENIZER.configure(vocab_file=args.vocab_file)
+  if args.token_cache_file is not None:
+    convert_lib.CACHED_TOKENIZER.load(args.token_cache_file)
+
+  cache = build_cache.BuildCache(
+      os.path.join(args.data_home, ".build_cache"),
+      vocab_file=convert_lib.TOKENIZER.vocab_file, rebuild=args.rebuild)
+
+  graph = schedule_lib.JobGraph()
+  preco_converter.add_jobs(graph, args.data_home, args.num_workers, args.binary)
+  conll_converter.add_jobs(graph, args.data_home, args.num_workers, args.binary)
+  # Jobs and their document workers send their token cache updates back here,
+  # so the stats and the saved cache cover every process
+  graph.run(args.num_jobs, cache,
+            setup=convert_lib.init_worker_tokenizer,
+            setup_args=(convert_lib.TOKENIZER.vocab_file,),
+            collect=convert_lib.drain_token_cache,
+            merge=convert_lib.merge_token_cache)
+
+  print("Token cache: {}".format(convert_lib.CACHED_TOKENIZER.stats()))
+  if convert_lib.TOKENIZER.load_time is not None:
+    print("Tokenizer load time: {:.2f}s".format(convert_lib.TOKENIZER.load_time))
+  if args.token_cache_file is not None:
+    convert_lib.CACHED_TOKENIZER.save(args.token_cache_file)
 
 
 
@@ -1,11 +1,20 @@
 import collections
-import numpy as np
-from bert import tokenization
+import copy
+import itertools
 import json
 import os
 
-VOCAB_FILE = "/mnt/nfs/scratch1/nnayak/mention_bottleneck/convert/cased_config_vocab/vocab.txt"
-TOKENIZER = tokenization.FullTokenizer(vocab_file=VOCAB_FILE, do_lower_case=False)
+import numpy as np
+
+import binary_lib
+import parallel_lib
+import span_lib
+import tokenizer_lib
+
+# Loaded on first use; see tokenizer_lib for how the vocab path is chosen
+TOKENIZER = tokenizer_lib.LazyTokenizer(do_lower_case=False)
+# Shared across all datasets, variants and splits converted in this process
+CACHED_TOKENIZER = tokenizer_lib.SubwordCache(TOKENIZER)
 
 class DatasetName(object):
   conll = 'conll12'
@@ -16,6 +25,7 @@ class Variation(object):
   sing = 'sing'
   gold = 'gold'
   goldconst = 'goldconst'
+  npsing = 'npsing'
   predconst = 'predconst'
 
 class DatasetSplit(object):
@@ -46,53 +56,42 @@ CLS = "[CLS]"
 SPL = "[SPL]"
 SEP = "[SEP]"
 
+DEFAULT_SEGMENT_LENS = [384, 512]
+
 
 class Dataset(object):
   def __init__(self, dataset_name):
     self.name = dataset_name
     self.documents = collections.defaultdict(list)
 
-  def dump_to_jsonl(self, file_name):
+  def dump_to_jsonl(self, file_name, max_segment_lens=DEFAULT_SEGMENT_LENS,
+                    stride=None, num_workers=1,
+                    chunk_size=parallel_lib.DEFAULT_CHUNK_SIZE, binary=False):
+    """Write one jsonl file per segment length, from a single BPE pass."""
 
     assert ProcessingStage.TOKENIZED in self.documents
-
-    if ProcessingStage.BPE_TOKENIZED not in self.documents:
-      self.documents[ProcessingStage.BPE_TOKENIZED] = [
-        bpe_tokenize_document(document, TOKENIZER)
-        for document in self.documents[ProcessingStage.TOKENIZED]]
-
-    for new_stage in [
-      ProcessingStage.SEGMENTED_384, ProcessingStage.SEGMENTED_512]:
-      if new_stage not in self.documents:
-        self.documents[new_stage] = [
-          segment_document(document, new_stage)
-          for document in self.documents[ProcessingStage.BPE_TOKENIZED]]
-
-      lines = [doc.dump_to_json() for doc in self.documents[new_stage]]
-    
-      assert file_name.endswith(".jsonl")
-      seg_filename =  file_name.replace(".jsonl", "_" + new_stage + ".jsonl")
-      with open(seg_filename, 'w') as f:
-        f.write("\n".join(lines))
+    stream_to_jsonl(self.documents[ProcessingStage.TOKENIZED], file_name,
+                    max_segment_lens, stride, num_workers, chunk_size, binary)
 
   def dump_to_conll(self, file_name, drop_singletons=False):
     assert ProcessingStage.TOKENIZED in self.documents
 
-    lines = [doc.dump_to_conll(drop_singletons)
-             for doc in self.documents[ProcessingStage.TOKENIZED]]
-  
     print("writing conll file")
-    assert file_name.endswith(".conll")
-    if drop_singletons:
-      file_name = file_name.replace(".conll", ".classic.conll")
-    else:
-      file_name = file_name.replace(".conll", ".sing.conll")
-    with open(file_name, 'w') as f:
-      f.write("\n".join(lines))
+    with ConllWriter(file_name, [drop_singletons]) as writer:
+      for document in self.documents[ProcessingStage.TOKENIZED]:
+        writer.write(document)
+
+
+def conll_file_name(file_name, drop_singletons):
+  assert file_name.endswith(".conll")
+  if drop_singletons:
+    return file_name.replace(".conll", ".classic.conll")
+  else:
+    return file_name.replace(".conll", ".sing.conll")
 
 
 def flatten(nonflat):
-  return sum(nonflat,[])
+  return list(itertools.chain.from_iterable(nonflat))
 
 
 class ProcessingStage(object):
@@ -111,8 +110,7 @@ class CorefDocument(object):
     self.doc_part = part
     self.status=init_status
 
-    self.clusters = []
-    self.injected_mentions = []
+    self.set_mentions([])
     self.sentences = []
     self.speakers = []
 
@@ -122,23 +120,43 @@ class CorefDocument(object):
     self.token_sentences = [] # Need to thread this through for parsing later
     self.other_info_json = other_info
 
+  # Mentions are kept as span_lib arrays from the time a document is read;
+  # they only become nested lists for output.
+
+  def set_mentions(self, clusters, injected_mentions=()):
+    self.mention_spans, self.mention_cluster_ids = span_lib.encode_mentions(
+        clusters, injected_mentions)
+    self.num_clusters = len(clusters)
+
+  @property
+  def clusters(self):
+    return span_lib.decode_mentions(self.mention_spans,
+                                    self.mention_cluster_ids,
+                                    self.num_clusters)[0]
+
+  @property
+  def injected_mentions(self):
+    return span_lib.decode_mentions(self.mention_spans,
+                                    self.mention_cluster_ids,
+                                    self.num_clusters)[1]
 
   def dump_to_json(self):
-    assert self.status in [ProcessingStage.SEGMENTED_512,
-        ProcessingStage.SEGMENTED_384]
+    assert is_segmented(self.status)
  
+    clusters, injected_mentions = span_lib.decode_mentions(
+        self.mention_spans, self.mention_cluster_ids, self.num_clusters)
     return json.dumps({
           "doc_key": self.doc_id + "_" + str(int(self.doc_part)),
           "sentences": self.sentences,
           "sentence_map": self.sentence_map,
           "subtoken_map": self.subtoken_map,
           "speakers": self.speakers,
-          "clusters": self.clusters,
-          "inject_mentions": self.injected_mentions,
+          "clusters": clusters,
+          "inject_mentions": injected_mentions,
           "other_info": json.loads(self.other_info_json),
           "token_sentences": self.token_sentences,
-          "bpe_maps": self.bpe_maps,
-          "subtoken_offsets": self.subtoken_offsets,
+          "bpe_maps": [subtokens.tolist() for subtokens in self.bpe_maps],
+          "subtoken_offsets": self.subtoken_offsets.tolist(),
           "format": self.status,
         })
 
@@ -148,14 +166,13 @@ class CorefDocument(object):
     else:
       return original_label + "|" + additional_label
 
-  def dump_to_conll(self, drop_singletons=False):
-    assert self.status == ProcessingStage.TOKENIZED
-    token_sentences = self.sentences
+  def conll_coref_labels(self, drop_singletons=False):
+    """Coref column value for every token in the document."""
     token_clusters = self.clusters
     if drop_singletons:
       token_clusters = [cluster for cluster in token_clusters if len(cluster) > 1]
   
-    flat_coref_labels = ["-"] * len(flatten(token_sentences))
+    flat_coref_labels = ["-"] * sum(len(sentence) for sentence in self.sentences)
     for idx, cluster in enumerate(token_clusters):
       for start, end in cluster:
         if start == end:
@@ -166,26 +183,39 @@ class CorefDocument(object):
               flat_coref_labels[start], "({}".format(str(idx)))
           flat_coref_labels[end] = self._update_label(
               flat_coref_labels[end], "{})".format(str(idx)))
+    return flat_coref_labels
+
+  def conll_row_prefixes(self):
+    """CoNLL lines without their coref column.
 
-    doc_lines = [
-        "#begin document ({}); part {}".format(self.doc_id, self.doc_part)]
+    Token rows are (prefix, flat token index) and end in a tab, ready for the
+    label; other lines have None as their index.
+    """
+    rows = [("#begin document ({}); part {}".format(self.doc_id, self.doc_part),
+             None)]
 
     str_doc_part = str(int(self.doc_part))
     token_offset = 0
-    for sentence, speakers in zip(token_sentences, self.speakers):
-      coref_labels = flat_coref_labels[
-          token_offset:token_offset+len(sentence)]
+    for sentence, speakers in zip(self.sentences, self.speakers):
+      for i, (token, speaker) in enumerate(zip(sentence, speakers)):
+        rows.append(("\t".join([self.doc_id, str_doc_part, str(i), token,
+        "_POS", "_PARSE", "_", "_", "_", speaker, "*", ""]), token_offset + i))
       token_offset += len(sentence)
-
-      for i, (token, label, speaker) in enumerate(
-          zip(sentence, coref_labels, speakers)):
-        doc_lines.append("\t".join([self.doc_id, str_doc_part, str(i), token,
-        "_POS", "_PARSE", "_", "_", "_", speaker, "*", label]))
-      doc_lines.append("")
+      rows.append(("", None))
   
-    doc_lines.append("#end document")
+    rows.append(("#end document", None))
+    return rows
 
-    return "\n".join(doc_lines)
+  def dump_to_conll(self, drop_singletons=False):
+    assert self.status == ProcessingStage.TOKENIZED
+    return join_conll_rows(self.conll_row_prefixes(),
+                           self.conll_coref_labels(drop_singletons))
+
+
+def join_conll_rows(row_prefixes, flat_coref_labels):
+  return "\n".join(prefix if token_idx is None
+                   else prefix + flat_coref_labels[token_idx]
+                   for prefix, token_idx in row_prefixes)
 
 
 def all_same(l):
@@ -201,10 +231,10 @@ def bpe_tokenize_document(document, tokenizer):
       document.other_info_json, ProcessingStage.BPE_TOKENIZED)
 
   bpe_document.token_sentences = document.sentences
-  bpe_document.token_clusters = document.clusters
 
-  token_to_starting_subtoken = []
-  token_to_ending_subtoken = []
+  token_subword_lens = []
+  # Cumulative subtoken count at the start of each sentence, plus the total
+  sentence_offsets = [0]
   cum_doc_token_count = 0
   previous_token = 0
 
@@ -215,14 +245,10 @@ def bpe_tokenize_document(document, tokenizer):
     assert all_same(multi_speakers)
     speaker, = tuple(set(multi_speakers))
 
-    subword_list = [TOKENIZER.tokenize(token) for token in sentence]
+    subword_list = [tokenizer.tokenize(token) for token in sentence]
 
-    # Construct mapping to subtoken for use in cluster stuff later
-    subtoken_offset = len(bpe_document.subtoken_map) # subtokens included so far
-    for i, (token, subwords) in enumerate(zip(sentence, subword_list)):
-      token_to_starting_subtoken.append(subtoken_offset)
-      subtoken_offset += len(subwords)
-      token_to_ending_subtoken.append(subtoken_offset - 1) # inclusive
+    # For mapping tokens to subtokens in cluster stuff later
+    token_subword_lens += [len(subwords) for subwords in subword_list]
 
     # For each subword, which original token did it come from (index from flat list)
     subtoken_map = flatten(
@@ -231,7 +257,7 @@ def bpe_tokenize_document(document, tokenizer):
         for in_sentence_token_idx, token_subwords in
         enumerate(subword_list)])
 
-    flattened_subword = sum(subword_list, [])
+    flattened_subword = flatten(subword_list)
 
     # Build various fields
     bpe_document.sentences.append(flattened_subword)
@@ -242,26 +268,28 @@ def bpe_tokenize_document(document, tokenizer):
     bpe_document.sentence_map += [sentence_idx] * len(flattened_subword) 
 
     cum_doc_token_count += len(sentence)
+    sentence_offsets.append(sentence_offsets[-1] + len(flattened_subword))
 
+  token_to_ending_subtoken = np.cumsum(
+      token_subword_lens, dtype=span_lib.INDEX_DTYPE) - 1 # inclusive
+  token_to_starting_subtoken = token_to_ending_subtoken + 1 - np.asarray(
+      token_subword_lens, dtype=span_lib.INDEX_DTYPE)
   assert same_len([token_to_ending_subtoken, token_to_starting_subtoken,
                    flatten(document.sentences)])
   assert same_len([bpe_document.sentence_map,
                    bpe_document.subtoken_map, flatten(bpe_document.sentences)])
            
 
-  # Remap clusters
-
-  bpe_document.clusters = remap_clusters(document.clusters,
-                                         token_to_starting_subtoken,
-                                         token_to_ending_subtoken,
-                                         cumulative=False)
-
-  (bpe_document.injected_mentions, ) = remap_clusters(
-      [document.injected_mentions], token_to_starting_subtoken,
-      token_to_ending_subtoken, cumulative=False)
+  # Remap clusters and injected mentions in one batch
+  bpe_document.mention_spans = remap_spans(
+      document.mention_spans, token_to_starting_subtoken,
+      token_to_ending_subtoken)
+  bpe_document.mention_cluster_ids = document.mention_cluster_ids
+  bpe_document.num_clusters = document.num_clusters
 
   bpe_document.bpe_maps = [token_to_starting_subtoken,
                            token_to_ending_subtoken]
+  bpe_document.sentence_offsets = sentence_offsets
                             
   
   return bpe_document
@@ -270,79 +298,180 @@ def bpe_tokenize_document(document, tokenizer):
 STAGE_TO_LEN ={ProcessingStage.SEGMENTED_384: 384,
                ProcessingStage.SEGMENTED_512: 512}
 
-def remap_clusters(clusters, start_offsets, optional_end_offsets=None,
-                   cumulative=False):
-  """Remap clusters. If cumulative, add offset to indices."""
-  if optional_end_offsets is None:
-    end_offsets = start_offsets
+def remap_spans(spans, start_offsets, end_offsets=None, cumulative=False):
+  """Remap an (n, 2) span array by fancy indexing into offset arrays.
+
+  If cumulative, the offsets are added to the indices rather than replacing
+  them.
+  """
+  if end_offsets is None:
+    new_spans = start_offsets[spans]
   else:
-    end_offsets = optional_end_offsets
-    
-  new_clusters = []
-  for cluster in clusters:
-    new_cluster = []
-    for start, end in cluster:
-      if cumulative:
-        new_start = start + start_offsets[start]
-        new_end = end + end_offsets[end]
-      else:
-        new_start = start_offsets[start]
-        new_end = end_offsets[end]
-      new_cluster.append([new_start, new_end])
-    new_clusters.append(new_cluster)
-
-  return new_clusters
+    new_spans = np.stack(
+        [start_offsets[spans[:, 0]], end_offsets[spans[:, 1]]], axis=1)
+  if cumulative:
+    new_spans += spans
+  return new_spans
 
 
-def segment_document(bpe_document, new_stage):
-  assert bpe_document.status == ProcessingStage.BPE_TOKENIZED
-  max_segment_len = STAGE_TO_LEN[new_stage]
+def segmented_stage(max_segment_len, stride=None):
+  """Name of the processing stage for a segment length (and optional stride)."""
+  stage = "SEGMENTED_{}".format(max_segment_len)
+  if stride is not None:
+    stage += "_STRIDE_{}".format(stride)
+  return stage
 
-  seg_document = CorefDocument(
-      bpe_document.doc_id, bpe_document.doc_part, bpe_document.other_info_json,
-      new_stage)
 
-  seg_document.token_sentences = bpe_document.token_sentences
-  seg_document.token_clusters = bpe_document.token_clusters
-  seg_document.bpe_maps = bpe_document.bpe_maps
+def is_segmented(status):
+  return status.startswith("SEGMENTED_")
 
+
+def sentence_segment_ranges(sentence_offsets, max_segment_len):
+  """Greedily pack whole sentences into segments.
+
+  Returns (first, exclusive last) subtoken index pairs, one per segment.
+  """
   # For each segment, a list of sentence indices which are part of that segment
   segment_maps = []
   current_segment = []
   current_segment_len = 0
   
   # Building segment maps
-  for i, sentence in enumerate(bpe_document.sentences):
+  for i in range(len(sentence_offsets) - 1):
+    sentence_len = sentence_offsets[i + 1] - sentence_offsets[i]
     # 2 is added for CLS and SEP
-    if len(sentence) + current_segment_len + 2 <= max_segment_len:
+    if sentence_len + current_segment_len + 2 <= max_segment_len:
       current_segment.append(i)
-      current_segment_len += len(sentence)
+      current_segment_len += sentence_len
     else:
       segment_maps.append(current_segment)
       current_segment = [i]
-      current_segment_len = len(sentence)
+      current_segment_len = sentence_len
   if current_segment:
     segment_maps.append(current_segment)
 
+  return [(sentence_offsets[sentence_indices[0]],
+           sentence_offsets[sentence_indices[-1] + 1])
+          for sentence_indices in segment_maps]
+
+
+def window_segment_ranges(num_subtokens, max_segment_len, stride):
+  """Overlapping windows of subtokens, a new one starting every `stride`.
+
+  Consecutive windows overlap by max_segment_len - 2 - stride subtokens.
+  """
+  window_len = max_segment_len - 2 # Room for CLS and SEP
+  assert 0 < stride < window_len, "Windows must overlap"
+  if not num_subtokens:
+    return []
+  ranges = []
+  start = 0
+  while True:
+    ranges.append((start, min(start + window_len, num_subtokens)))
+    if start + window_len >= num_subtokens:
+      break
+    start += stride
+  return ranges
+
+
+def segments_overlap(segment_ranges):
+  return any(start < prev_end for (_, prev_end), (start, _)
+             in zip(segment_ranges, segment_ranges[1:]))
+
+
+def remap_windowed_spans(spans, segment_ranges):
+  """Remap an (n, 2) array of subtoken spans into overlapping windows.
+
+  A span goes to the first window containing it entirely. Spans longer than
+  the overlap may not fit in any window; these can't be represented without
+  crossing a SEP and CLS, so they are dropped.
+
+  Returns the remapped spans that were kept and a boolean mask of which input
+  spans those are.
+  """
+  window_starts = np.array([start for start, _ in segment_ranges])
+  window_ends = np.array([end for _, end in segment_ranges])
+  # Index of each window's CLS in the flattened segmented document
+  flat_starts = np.concatenate(
+      [[0], np.cumsum(window_ends - window_starts + 2)[:-1]])
+  # Added to a subtoken index to get its position within each window
+  window_offsets = flat_starts + 1 - window_starts
+
+  starts, ends = spans[:, 0], spans[:, 1]
+  # Windows start in order, so the first window containing a span's end is
+  # the one most likely to contain its start too
+  windows = np.searchsorted(window_ends, ends, side='right')
+  keep = starts >= window_starts[windows]
+  spans = spans[keep] + window_offsets[windows[keep], None].astype(spans.dtype)
+  return spans, keep
 
-  # For each subtoken, how many indices it is bumped by due to CLS and SEP tokens
-  subtoken_offsets = []
-  subtoken_offset = 0
 
-  prev_subtoken = 0
-  for sentence_indices in segment_maps:
-    start_sentence_idx = sentence_indices[0]
-    exc_end_sentence_idx = sentence_indices[-1] + 1
-    first_subtoken_index = len(flatten(bpe_document.sentences[:start_sentence_idx]))
-    last_subtoken_index = len(flatten(bpe_document.sentences[:exc_end_sentence_idx]))
+def segment_document(bpe_document, new_stage):
+  (seg_document,) = segment_document_multi(
+      bpe_document, [STAGE_TO_LEN[new_stage]]).values()
+  return seg_document
+
+
+def segment_document_multi(bpe_document, max_segment_lens, stride=None):
+  """Segment one BPE document at every requested maximum segment length.
+
+  Flattened subtokens and the sentence offset index are shared by all
+  lengths. Without a stride, segments are packed with whole sentences. With a
+  stride, segments are overlapping windows of subtokens.
+
+  Returns an OrderedDict from processing stage to segmented document.
+  """
+  assert bpe_document.status == ProcessingStage.BPE_TOKENIZED
+
+  flat_subtokens = flatten(bpe_document.sentences)
+  flat_speakers = flatten(bpe_document.speakers)
+
+  seg_documents = collections.OrderedDict()
+  for max_segment_len in max_segment_lens:
+    new_stage = segmented_stage(max_segment_len, stride)
+    if stride is None:
+      segment_ranges = sentence_segment_ranges(
+          bpe_document.sentence_offsets, max_segment_len)
+    else:
+      segment_ranges = window_segment_ranges(
+          len(flat_subtokens), max_segment_len, stride)
+    seg_documents[new_stage] = build_segmented_document(
+        bpe_document, new_stage, segment_ranges, flat_subtokens,
+        flat_speakers)
+
+  return seg_documents
+
+
+def build_segmented_document(bpe_document, new_stage, segment_ranges,
+                             flat_subtokens, flat_speakers):
+  seg_document = CorefDocument(
+      bpe_document.doc_id, bpe_document.doc_part, bpe_document.other_info_json,
+      new_stage)
 
-    segment = [CLS] + flatten(bpe_document.sentences[start_sentence_idx:exc_end_sentence_idx]) + [SEP]
+  seg_document.token_sentences = bpe_document.token_sentences
+  seg_document.bpe_maps = bpe_document.bpe_maps
+
+  # For each segment, how many indices its subtokens are bumped by due to CLS
+  # and SEP tokens, and how many of them are new. With overlapping windows, a
+  # subtoken counts for the first window containing it.
+  segment_offsets = []
+  num_unseen_subtokens = []
+  num_seen = 0
+  segment_start = 0 # Index of the segment's CLS in the flattened document
+
+  overlapping = segments_overlap(segment_ranges)
+  prev_subtoken = 0
+  for first_subtoken_index, last_subtoken_index in segment_ranges:
+    segment = [CLS] + flat_subtokens[first_subtoken_index:last_subtoken_index] + [SEP]
     seg_document.sentences.append(segment)
     seg_document.speakers.append(
-      [SPL] + flatten(bpe_document.speakers[start_sentence_idx:exc_end_sentence_idx]) + [SPL])
+      [SPL] + flat_speakers[first_subtoken_index:last_subtoken_index] + [SPL])
 
-    seg_document.subtoken_map.append( # CLS takes previous subtoken index
-        prev_subtoken)
+    # CLS takes the previous subtoken's index, or with overlapping windows the
+    # first subtoken's, so the map doesn't go backwards within a window
+    seg_document.subtoken_map.append(
+        bpe_document.subtoken_map[first_subtoken_index] if overlapping
+        else prev_subtoken)
     seg_document.subtoken_map +=  bpe_document.subtoken_map[first_subtoken_index:last_subtoken_index]
     this_sentence_last_subtoken = bpe_document.subtoken_map[last_subtoken_index - 1]
     seg_document.subtoken_map.append( # Presumably SEP shares index of last word
@@ -355,27 +484,429 @@ def segment_document(bpe_document, new_stage):
     seg_document.sentence_map.append( # SEP has index of presumptive next sentence
         bpe_document.sentence_map[last_subtoken_index -  1] + 1)
 
-    subtoken_offset += 1 # for the CLS token
-    subtoken_offsets += [subtoken_offset] * (len(segment) - 2)
-    subtoken_offset += 1 # for the SEP token
+    # Windows may overlap; only subtokens not seen in an earlier window count
+    segment_offsets.append(segment_start + 1 - first_subtoken_index) # +1 for CLS
+    num_unseen_subtokens.append(last_subtoken_index - num_seen)
+    num_seen = last_subtoken_index
+    segment_start += len(segment)
   
-   
-  assert same_len([subtoken_offsets,
-                   flatten(bpe_document.sentences)])
+  subtoken_offsets = np.repeat(
+      np.asarray(segment_offsets, dtype=span_lib.INDEX_DTYPE),
+      num_unseen_subtokens)
+  assert len(subtoken_offsets) == len(flat_subtokens)
   assert same_len([seg_document.sentence_map,
                    seg_document.subtoken_map, flatten(seg_document.sentences)])
 
-  seg_document.clusters = remap_clusters(bpe_document.clusters,
-                                         subtoken_offsets,
-                                         cumulative=True)
-
-  (seg_document.injected_mentions, ) = remap_clusters(
-      [bpe_document.injected_mentions], subtoken_offsets, cumulative=True)
-  
+  seg_document.segment_ranges = segment_ranges
   seg_document.subtoken_offsets = subtoken_offsets
+  (seg_document.mention_spans, seg_document.mention_cluster_ids,
+   seg_document.num_clusters, seg_document.num_dropped_mentions) = (
+       segment_mentions(bpe_document, segment_ranges, subtoken_offsets))
                              
   return seg_document
+
+
+def segment_mentions(bpe_document, segment_ranges, subtoken_offsets):
+  """Mention arrays of a BPE document, in segmented indices.
+
+  Returns (spans, cluster_ids, num_clusters, number of mentions dropped for
+  not fitting in any window). Clusters left without mentions are dropped as
+  well.
+  """
+  cluster_ids = bpe_document.mention_cluster_ids
+  if not segments_overlap(segment_ranges):
+    mention_spans = remap_spans(bpe_document.mention_spans, subtoken_offsets,
+                                cumulative=True)
+    return mention_spans, cluster_ids, bpe_document.num_clusters, 0
+
+  mention_spans, keep = remap_windowed_spans(
+      bpe_document.mention_spans, segment_ranges)
+  cluster_ids = cluster_ids[keep]
+  # Renumber the clusters that still have mentions; injected mentions follow
+  is_kept = np.bincount(cluster_ids,
+                        minlength=bpe_document.num_clusters + 1) > 0
+  is_kept[bpe_document.num_clusters] = True
+  new_ids = np.cumsum(is_kept, dtype=span_lib.INDEX_DTYPE) - 1
+  return (mention_spans, new_ids[cluster_ids], int(new_ids[-1]),
+          len(keep) - int(keep.sum()))
+
+
+# Variants of a document (e.g. the CoNLL alternates) share tokens, sentences
+# and speakers and differ only in their mentions, so BPE tokenization and
+# segmentation are done once and reused; each variant only remaps mentions.
+
+def bpe_variant(bpe_document, document):
+  """`bpe_document` with the mentions and other_info of `document` instead.
+
+  All token-level fields are shared with `bpe_document`, not copied.
+  """
+  assert document.sentences == bpe_document.token_sentences
+  variant = copy.copy(bpe_document)
+  variant.other_info_json = document.other_info_json
+  token_to_starting_subtoken, token_to_ending_subtoken = bpe_document.bpe_maps
+  variant.mention_spans = remap_spans(
+      document.mention_spans, token_to_starting_subtoken,
+      token_to_ending_subtoken)
+  variant.mention_cluster_ids = document.mention_cluster_ids
+  variant.num_clusters = document.num_clusters
+  return variant
+
+
+def segmented_variant(seg_document, bpe_document):
+  """`seg_document` with the mentions of the variant `bpe_document`."""
+  variant = copy.copy(seg_document)
+  variant.other_info_json = bpe_document.other_info_json
+  (variant.mention_spans, variant.mention_cluster_ids, variant.num_clusters,
+   variant.num_dropped_mentions) = segment_mentions(
+       bpe_document, seg_document.segment_ranges, seg_document.subtoken_offsets)
+  return variant
     
  
-def write_converted(dataset, prefix):
-  dataset.dump_to_jsonl(prefix + ".jsonl")
+# Streaming conversion: documents flow through one at a time, so memory is
+# bounded by the largest document rather than the whole split.
+
+SerializedDocument = collections.namedtuple(
+    "SerializedDocument", ["line", "arrays", "num_dropped_mentions"])
+
+
+def serialize_document(document, tokenizer, max_segment_lens, stride=None,
+                       binary=False):
+  """BPE-tokenize, segment and serialize one TOKENIZED document.
+
+  Returns an OrderedDict from segmented stage to SerializedDocument, holding
+  the jsonl line, if `binary` the arrays for binary_lib, and the number of
+  mentions dropped for not fitting in any window.
+  """
+  bpe_document = bpe_tokenize_document(document, tokenizer)
+  seg_documents = segment_document_multi(bpe_document, max_segment_lens, stride)
+  return serialize_segmented(seg_documents, tokenizer, binary)
+
+
+def prepare_and_serialize(item, tokenizer, max_segment_lens, stride=None,
+                          binary=False, prepare_fn=None,
+                          conll_drop_singletons=()):
+  """serialize_document for prepare_fn(item), along with its CoNLL texts.
+
+  `prepare_fn` turns an input item, e.g. a raw line, into a TOKENIZED
+  document; without it the item is the document. Returns (serialized,
+  conll_texts), the latter as from conll_texts.
+  """
+  document = item if prepare_fn is None else prepare_fn(item)
+  return (serialize_document(
+      document, tokenizer, max_segment_lens, stride, binary),
+          conll_texts(document, conll_drop_singletons))
+
+
+def serialize_segmented(seg_documents, tokenizer, binary=False):
+  return collections.OrderedDict(
+      (new_stage, SerializedDocument(
+          seg_document.dump_to_json(),
+          binary_lib.encode_document(seg_document, tokenizer)
+          if binary else None,
+          seg_document.num_dropped_mentions))
+      for new_stage, seg_document in seg_documents.items())
+
+
+def serialize_variants(variant_documents, tokenizer, max_segment_lens,
+                       stride=None, binary=False):
+  """serialize_document for every variant of one document.
+
+  Only the first variant is BPE-tokenized and segmented; the others reuse its
+  maps and remap just their own mentions.
+
+    Args:
+      variant_documents: OrderedDict from variant to TOKENIZED document
+
+    Returns:
+      OrderedDict from variant to serialize_document's result
+  """
+  serialized = collections.OrderedDict()
+  bpe_document = None
+  for variant, document in variant_documents.items():
+    if bpe_document is None:
+      bpe_document = bpe_tokenize_document(document, tokenizer)
+      seg_documents = segment_document_multi(
+          bpe_document, max_segment_lens, stride)
+      variant_seg_documents = seg_documents
+    else:
+      variant_bpe_document = bpe_variant(bpe_document, document)
+      variant_seg_documents = collections.OrderedDict(
+          (new_stage, segmented_variant(seg_document, variant_bpe_document))
+          for new_stage, seg_document in seg_documents.items())
+    serialized[variant] = serialize_segmented(
+        variant_seg_documents, tokenizer, binary)
+  return serialized
+
+
+class JsonlWriter(object):
+  """One output file per segmented stage, written a document at a time.
+
+  If `binary`, each stage is also written in binary_lib's memory-mappable
+  format to a directory next to its jsonl file. Mentions dropped during
+  windowed segmentation are counted per stage and reported on close.
+  """
+  def __init__(self, file_name, new_stages, binary=False):
+    assert file_name.endswith(".jsonl")
+    self.stage_file_names = stage_file_names = collections.OrderedDict(
+        (new_stage, file_name.replace(".jsonl", "_" + new_stage + ".jsonl"))
+        for new_stage in new_stages)
+    self.files = collections.OrderedDict(
+        (new_stage, open(stage_file_name, 'w'))
+        for new_stage, stage_file_name in stage_file_names.items())
+    self.binary_writers = collections.OrderedDict()
+    if binary:
+      for new_stage, stage_file_name in stage_file_names.items():
+        self.binary_writers[new_stage] = binary_lib.BinaryWriter(
+            binary_lib.binary_dir_name(stage_file_name))
+    self.num_written = 0
+    self.num_dropped_mentions = collections.Counter()
+
+  def write(self, serialized):
+    for new_stage, f in self.files.items():
+      if self.num_written:
+        f.write("\n")
+      f.write(serialized[new_stage].line)
+      self.num_dropped_mentions[new_stage] += (
+          serialized[new_stage].num_dropped_mentions)
+    for new_stage, binary_writer in self.binary_writers.items():
+      binary_writer.write(serialized[new_stage].arrays)
+    self.num_written += 1
+
+  def close(self):
+    for f in self.files.values():
+      f.close()
+    for binary_writer in self.binary_writers.values():
+      binary_writer.close()
+    for new_stage, num_dropped in self.num_dropped_mentions.items():
+      if num_dropped:
+        print("Dropped {} mentions wider than the window overlap from {}".format(
+            num_dropped, self.stage_file_names[new_stage]))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.close()
+
+
+def configure_tokenizer(vocab_file):
+  """Pool initializer: worker processes build their own tokenizer from this."""
+  TOKENIZER.configure(vocab_file)
+
+
+def init_worker_tokenizer(vocab_file):
+  """Sets up a process that reports back its token cache; safe to repeat."""
+  configure_tokenizer(vocab_file)
+  CACHED_TOKENIZER.drain_updates() # Forget what was inherited from the parent
+
+
+def drain_token_cache():
+  """CACHED_TOKENIZER's updates since the last drain, for merge_token_cache."""
+  return CACHED_TOKENIZER.drain_updates()
+
+
+def merge_token_cache(updates):
+  CACHED_TOKENIZER.merge_updates(updates)
+
+
+_WORKER_SEGMENT_OPTIONS = None
+
+def _init_serialize_worker(max_segment_lens, stride, binary, vocab_file,
+                           prepare_fn=None, conll_drop_singletons=()):
+  """Runs once per worker process; the tokenizer is per process as well."""
+  global _WORKER_SEGMENT_OPTIONS
+  _WORKER_SEGMENT_OPTIONS = (max_segment_lens, stride, binary, prepare_fn,
+                             conll_drop_singletons)
+  init_worker_tokenizer(vocab_file)
+
+
+# Workers return each result with the token cache updates made producing it,
+# which the parent merges into its own CACHED_TOKENIZER
+
+def _serialize_in_worker(item):
+  return (prepare_and_serialize(item, CACHED_TOKENIZER,
+                                *_WORKER_SEGMENT_OPTIONS),
+          drain_token_cache())
+
+
+def _serialize_variants_in_worker(variant_documents):
+  max_segment_lens, stride, binary, _, _ = _WORKER_SEGMENT_OPTIONS
+  return (serialize_variants(
+      variant_documents, CACHED_TOKENIZER, max_segment_lens, stride, binary),
+          drain_token_cache())
+
+
+def merge_worker_results(results):
+  """Yield results of the *_in_worker functions, merging their cache updates."""
+  for result, updates in results:
+    merge_token_cache(updates)
+    yield result
+
+
+def stream_to_jsonl(documents, file_name, max_segment_lens=DEFAULT_SEGMENT_LENS,
+                    stride=None, num_workers=1,
+                    chunk_size=parallel_lib.DEFAULT_CHUNK_SIZE, binary=False,
+                    prepare_fn=None, conll_file=None,
+                    conll_drop_singletons=(True, False)):
+  """Convert an iterable of TOKENIZED documents, writing each immediately.
+
+  With more than one worker, documents are converted in a process pool in
+  chunks of `chunk_size`; output order is the same as input order.
+
+  With `prepare_fn`, `documents` are raw items (e.g. lines) that prepare_fn
+  turns into documents, in the workers as well. With `conll_file`, each
+  document is also written to CoNLL, as ConllWriter does.
+  """
+  new_stages = [segmented_stage(max_segment_len, stride)
+                for max_segment_len in max_segment_lens]
+  if conll_file is None:
+    conll_drop_singletons = ()
+  options = (max_segment_lens, stride, binary, prepare_fn,
+             conll_drop_singletons)
+  if num_workers > 1:
+    results = merge_worker_results(parallel_lib.ordered_map(
+        _serialize_in_worker, documents, num_workers, chunk_size,
+        initializer=_init_serialize_worker,
+        initargs=(max_segment_lens, stride, binary, TOKENIZER.vocab_file,
+                  prepare_fn, conll_drop_singletons)))
+  else:
+    results = (prepare_and_serialize(document, CACHED_TOKENIZER, *options)
+               for document in documents)
+  with JsonlWriter(file_name, new_stages, binary) as writer, ConllWriter(
+      conll_file, conll_drop_singletons) as conll_writer:
+    for document_serialized, document_conll_texts in results:
+      writer.write(document_serialized)
+      conll_writer.write_texts(document_conll_texts)
+
+
+def stream_variants_to_jsonl(variant_documents, file_names,
+                             max_segment_lens=DEFAULT_SEGMENT_LENS, stride=None,
+                             num_workers=1,
+                             chunk_size=parallel_lib.DEFAULT_CHUNK_SIZE,
+                             binary=False):
+  """stream_to_jsonl for several variants of the same documents at once.
+
+    Args:
+      variant_documents: iterable of OrderedDicts from variant to TOKENIZED
+        document, as taken by serialize_variants
+      file_names: OrderedDict from variant to its output jsonl file
+  """
+  new_stages = [segmented_stage(max_segment_len, stride)
+                for max_segment_len in max_segment_lens]
+  if num_workers > 1:
+    serialized = merge_worker_results(parallel_lib.ordered_map(
+        _serialize_variants_in_worker, variant_documents, num_workers,
+        chunk_size, initializer=_init_serialize_worker,
+        initargs=(max_segment_lens, stride, binary, TOKENIZER.vocab_file)))
+  else:
+    serialized = (serialize_variants(
+        documents, CACHED_TOKENIZER, max_segment_lens, stride, binary)
+        for documents in variant_documents)
+  writers = collections.OrderedDict(
+      (variant, JsonlWriter(file_name, new_stages, binary))
+      for variant, file_name in file_names.items())
+  try:
+    for variants_serialized in serialized:
+      for variant, writer in writers.items():
+        writer.write(variants_serialized[variant])
+  finally:
+    for writer in writers.values():
+      writer.close()
+
+
+CONLL_BUFFER_SIZE = 1 << 22
+
+
+def conll_texts(document, drop_singletons_values=(True, False)):
+  """A TOKENIZED document's CoNLL text for each drop_singletons value."""
+  assert document.status == ProcessingStage.TOKENIZED
+  if not drop_singletons_values:
+    return {}
+  row_prefixes = document.conll_row_prefixes()
+  return {drop_singletons: join_conll_rows(
+              row_prefixes, document.conll_coref_labels(drop_singletons))
+          for drop_singletons in drop_singletons_values}
+
+
+class ConllWriter(object):
+  """Streams TOKENIZED documents to CoNLL, one file per drop_singletons value.
+
+  All files are written from a single walk over each document, through large
+  write buffers, so memory is bounded by the largest document.
+  """
+  def __init__(self, file_name, drop_singletons_values=(True, False),
+               buffer_size=CONLL_BUFFER_SIZE):
+    self.files = collections.OrderedDict(
+        (drop_singletons, open(conll_file_name(file_name, drop_singletons), 'w',
+                               buffering=buffer_size))
+        for drop_singletons in drop_singletons_values)
+    self.num_written = 0
+
+  def write(self, document):
+    self.write_texts(conll_texts(document, self.files.keys()))
+
+  def write_texts(self, texts):
+    """Writes a document already rendered by conll_texts."""
+    for drop_singletons, f in self.files.items():
+      if self.num_written:
+        f.write("\n")
+      f.write(texts[drop_singletons])
+    self.num_written += 1
+
+  def close(self):
+    for f in self.files.values():
+      f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.close()
+
+
+def tee_to_conll(documents, file_name, drop_singletons_values=(True, False)):
+  """Write each TOKENIZED document to CoNLL as it passes through."""
+  with ConllWriter(file_name, drop_singletons_values) as writer:
+    for document in documents:
+      writer.write(document)
+      yield document
+
+
+def converted_file_names(prefix, max_segment_lens=DEFAULT_SEGMENT_LENS,
+                         stride=None, binary=False):
+  """Every file (or binary directory) stream_converted writes for `prefix`."""
+  file_names = []
+  for max_segment_len in max_segment_lens:
+    file_name = prefix + "_" + segmented_stage(max_segment_len, stride) + ".jsonl"
+    file_names.append(file_name)
+    if binary:
+      file_names.append(binary_lib.binary_dir_name(file_name))
+  return file_names
+
+
+def write_converted(dataset, prefix, max_segment_lens=DEFAULT_SEGMENT_LENS,
+                    stride=None, num_workers=1,
+                    chunk_size=parallel_lib.DEFAULT_CHUNK_SIZE, binary=False):
+  dataset.dump_to_jsonl(prefix + ".jsonl", max_segment_lens, stride,
+                        num_workers, chunk_size, binary)
+
+
+def stream_converted(documents, prefix, max_segment_lens=DEFAULT_SEGMENT_LENS,
+                     stride=None, num_workers=1,
+                     chunk_size=parallel_lib.DEFAULT_CHUNK_SIZE, binary=False,
+                     prepare_fn=None, conll_file=None,
+                     conll_drop_singletons=(True, False)):
+  stream_to_jsonl(documents, prefix + ".jsonl", max_segment_lens, stride,
+                  num_workers, chunk_size, binary, prepare_fn, conll_file,
+                  conll_drop_singletons)
+
+
+def stream_variants_converted(variant_documents, prefixes,
+                              max_segment_lens=DEFAULT_SEGMENT_LENS,
+                              stride=None, num_workers=1,
+                              chunk_size=parallel_lib.DEFAULT_CHUNK_SIZE,
+                              binary=False):
+  file_names = collections.OrderedDict(
+      (variant, prefix + ".jsonl") for variant, prefix in prefixes.items())
+  stream_variants_to_jsonl(variant_documents, file_names, max_segment_lens,
+                           stride, num_workers, chunk_size, binary)
@@ -0,0 +1,49 @@
+"""Order-preserving process pool helpers."""
+
+import collections
+import itertools
+import multiprocessing
+
+DEFAULT_CHUNK_SIZE = 16
+DEFAULT_MAX_PENDING = 4 # Outstanding chunks per worker
+
+
+def iter_chunks(items, chunk_size):
+  items = iter(items)
+  while True:
+    chunk = list(itertools.islice(items, chunk_size))
+    if not chunk:
+      return
+    yield chunk
+
+
+def _map_chunk(fn, chunk):
+  return [fn(item) for item in chunk]
+
+
+def ordered_map(fn, items, num_workers, chunk_size=DEFAULT_CHUNK_SIZE,
+                initializer=None, initargs=(),
+                max_pending=DEFAULT_MAX_PENDING):
+  """Lazily yield fn(item) for each item, in input order.
+
+  Unlike Pool.imap, input is only read a bounded number of chunks ahead of
+  the consumer, so memory does not grow with the length of `items`. `fn` and
+  `initializer` must be picklable (module-level) functions; the initializer
+  runs once in every worker, which is where per-process state such as the
+  tokenizer should be set up.
+  """
+  pool = multiprocessing.Pool(num_workers, initializer, initargs)
+  pending = collections.deque()
+  try:
+    for chunk in iter_chunks(items, chunk_size):
+      pending.append(pool.apply_async(_map_chunk, (fn, chunk)))
+      if len(pending) >= max_pending * num_workers:
+        for result in pending.popleft().get():
+          yield result
+    while pending:
+      for result in pending.popleft().get():
+        yield result
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
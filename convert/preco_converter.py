@@ -3,15 +3,14 @@ import json
 import random
 import tqdm
 
+import binary_lib
 import convert_lib
 import preco_lib
+import schedule_lib
+import span_lib
 
 DUMMY_DOC_PART = '0'
 
-def get_lines_from_file(filename):
-  with open(filename, 'r') as f:
-    return f.readlines()
-
 def condense_sentences(sentences):
   """Need to figure out what this actually does and why."""
   sentence_index_map = {}
@@ -42,53 +41,74 @@ def condense_sentences(sentences):
 def make_empty_speakers(sentences):
   return [["" for token in sent] for sent in sentences]
 
-def create_dataset(filename):
-  dataset = convert_lib.Dataset(convert_lib.DatasetName.preco)
-  lines = get_lines_from_file(filename)
-
-  for line in tqdm.tqdm(lines):
-    orig_document = json.loads(line)
-    new_document = convert_lib.CorefDocument(
-        convert_lib.make_doc_id("preco", orig_document["id"]), DUMMY_DOC_PART,
-            init_status=convert_lib.ProcessingStage.TOKENIZED)
-    sentence_offsets = []
-    token_count = 0
-  
-    new_sentences, sentence_index_map, sentence_offsets = condense_sentences(
-        orig_document["sentences"])
-  
-    new_document.sentences = new_sentences
-    new_document.speakers = make_empty_speakers(new_document.sentences)
-    new_document.clusters = []
-    for cluster in orig_document["mention_clusters"]:
-        new_cluster = []
-        for sentence, begin, end in cluster:
-          modified_sentence = sentence_index_map[sentence]
-          new_cluster.append([sentence_offsets[modified_sentence] + begin,
-          sentence_offsets[modified_sentence] + end - 1])
-        new_document.clusters.append(new_cluster)
-    dataset.documents[convert_lib.ProcessingStage.TOKENIZED].append(new_document)
-
-  return dataset
-
-def convert_format(data_home):
-  """Convert preco json format into spanbert json format."""
+def convert_line(line):
+  """TOKENIZED CorefDocument from one line of a PreCo jsonl file."""
+  return convert_document(json.loads(line))
+
+
+def convert_document(orig_document):
+  new_document = convert_lib.CorefDocument(
+      convert_lib.make_doc_id("preco", orig_document["id"]), DUMMY_DOC_PART,
+          init_status=convert_lib.ProcessingStage.TOKENIZED)
+  sentence_offsets = []
+  token_count = 0
+
+  new_sentences, sentence_index_map, sentence_offsets = condense_sentences(
+      orig_document["sentences"])
+
+  new_document.sentences = new_sentences
+  new_document.speakers = make_empty_speakers(new_document.sentences)
+  clusters = []
+  for cluster in orig_document["mention_clusters"]:
+      new_cluster = []
+      for sentence, begin, end in cluster:
+        modified_sentence = sentence_index_map[sentence]
+        new_cluster.append([sentence_offsets[modified_sentence] + begin,
+        sentence_offsets[modified_sentence] + end - 1])
+      clusters.append(new_cluster)
+  new_document.set_mentions(clusters)
+  return new_document
+
+
+def convert_split(input_filename, output_prefix, num_workers=1, binary=False):
+  """Converts one split, writing its CoNLL files on the way.
+
+  Raw lines go to the serialize workers, which decode, convert and segment
+  each document in one go; output stays in file order.
+  """
+  with open(input_filename, 'r') as f:
+    convert_lib.stream_converted(
+        tqdm.tqdm(f), output_prefix, num_workers=num_workers, binary=binary,
+        prepare_fn=convert_line,
+        conll_file=input_filename.replace(".jsonl", ".conll"),
+        conll_drop_singletons=[True, False])
+
+
+def convert_split_outputs(input_filename, output_prefix, binary=False):
+  conll_filename = input_filename.replace(".jsonl", ".conll")
+  return [convert_lib.conll_file_name(conll_filename, drop_singletons)
+          for drop_singletons in [True, False]] + (
+      convert_lib.converted_file_names(output_prefix, binary=binary))
+
+
+def add_format_jobs(graph, data_home, num_workers=1, binary=False, deps=()):
+  """Adds one convert_split job per split; returns {split: job name}."""
   input_directory = os.path.join(data_home, "original", "preco")
   output_directory = os.path.join(data_home, "processed", "preco/all_info")
   convert_lib.create_dir(output_directory)
+  jobs = {}
   for split in [convert_lib.DatasetSplit.train, convert_lib.DatasetSplit.dev,
     convert_lib.DatasetSplit.test]:
     input_filename = os.path.join(input_directory, split + ".jsonl")
-    converted_dataset = create_dataset(input_filename)
-    for drop_singeltons in [True, False]:
-      converted_dataset.dump_to_conll(input_filename.replace(".jsonl", ".conll"),
-        drop_singeltons)
-    convert_lib.write_converted(converted_dataset, output_directory + "/" + split)
- 
+    output_prefix = output_directory + "/" + split
+    jobs[split] = graph.add(
+        "preco/format/" + split, convert_split,
+        [input_filename, output_prefix, num_workers, binary], deps=deps,
+        inputs=[input_filename],
+        outputs=convert_split_outputs(input_filename, output_prefix, binary),
+        params={"binary": binary})
+  return jobs
 
-def get_examples(filename):
-  with open(filename, 'r') as f:
-    return [json.loads(line) for line in f.readlines()]
 
 def get_sing_injected(example):
   return sum(example["clusters"], [])
@@ -113,19 +133,76 @@ FN_MAP = {
 def keep_singletons(inject_type):
   return inject_type == "goldsing"
 
-def create_injected_file(superset_filename, inject_type, max_seg_len):
-  superset_filename = superset_filename.replace(".jsonl", "_" + max_seg_len + ".jsonl")
-  examples = get_examples(superset_filename)
-  for example in examples:
-    example["injected_mentions"] = FN_MAP[inject_type](example)
-    if not keep_singletons(inject_type):
-      clusters = [cluster for cluster in example["clusters"] if len(cluster) >1]
-      example["clusters"] = clusters
-      
-  out_file = superset_filename.replace("all_info", inject_type)
-  convert_lib.create_dir("/".join(out_file.split("/")[:-1]))
-  with open(out_file, 'w') as f:
-    f.write("\n".join(json.dumps(example) for example in examples))
+def segmented_file_name(superset_filename, max_seg_len):
+  return superset_filename.replace(".jsonl", "_" + max_seg_len + ".jsonl")
+
+def injected_file_name(superset_filename, inject_type, max_seg_len):
+  return segmented_file_name(superset_filename, max_seg_len).replace(
+      "all_info", inject_type)
+
+
+def inject_example(example, inject_type):
+  """Copy of `example` with inject_type's mentions; `example` is not changed."""
+  injected = dict(example)
+  injected["injected_mentions"] = FN_MAP[inject_type](example)
+  if not keep_singletons(inject_type):
+    injected["clusters"] = [
+        cluster for cluster in example["clusters"] if len(cluster) > 1]
+  return injected
+
+
+def injected_file_names(superset_filename, inject_types, max_seg_len,
+                        binary=False):
+  """Every file (or binary directory) create_injected_files writes."""
+  file_names = []
+  for inject_type in inject_types:
+    file_name = injected_file_name(superset_filename, inject_type, max_seg_len)
+    file_names.append(file_name)
+    if binary:
+      file_names.append(binary_lib.binary_dir_name(file_name))
+  return file_names
+
+
+def create_injected_files(superset_filename, inject_types, max_seg_len,
+                          binary=False):
+  """Every inject type from a single streaming read of the all_info file.
+
+  Only one example is in memory at a time. If `binary`, each inject type also
+  gets a binary directory holding just its mentions; subtokens and segments
+  are shared with the all_info binary directory written by the format job.
+  """
+  segmented_filename = segmented_file_name(superset_filename, max_seg_len)
+  out_files = [injected_file_name(superset_filename, inject_type, max_seg_len)
+               for inject_type in inject_types]
+  for out_file in out_files:
+    convert_lib.create_dir("/".join(out_file.split("/")[:-1]))
+  fs = [open(out_file, 'w') for out_file in out_files]
+  binary_writers = []
+  if binary:
+    binary_writers = [binary_lib.BinaryWriter(
+        binary_lib.binary_dir_name(out_file), binary_lib.MENTION_GROUPS,
+        shared_dir=binary_lib.binary_dir_name(segmented_filename))
+        for out_file in out_files]
+  try:
+    with open(segmented_filename, 'r') as f:
+      for i, line in enumerate(f):
+        example = json.loads(line)
+        for j, (inject_type, out_f) in enumerate(zip(inject_types, fs)):
+          injected = inject_example(example, inject_type)
+          if i:
+            out_f.write("\n")
+          out_f.write(json.dumps(injected))
+          if binary_writers:
+            spans, cluster_ids = span_lib.encode_mentions(
+                injected["clusters"], injected["injected_mentions"])
+            binary_writers[j].write(binary_lib.encode_mentions(
+                injected["doc_key"], spans, cluster_ids,
+                len(injected["clusters"])))
+  finally:
+    for out_f in fs:
+      out_f.close()
+    for binary_writer in binary_writers:
+      binary_writer.close()
 
 
 _maybe_unused = """
@@ -151,16 +228,34 @@ def conllify_dataset(jsonl_file):
       dataset.documents[convert_lib.ProcessingStage.TOKENIZED].append(document)
     dataset.dump_to_conll(conll_file)"""
 
-def convert(data_home):
+def add_jobs(graph, data_home, num_workers=1, binary=False):
+  """Every job of `convert`: resplit -> format conversion -> injection."""
   # Just makes train-test splits
-  preco_lib.preprocess(data_home)
+  resplit_inputs, resplit_outputs = preco_lib.resplit_file_names(data_home)
+  resplit_job = graph.add("preco/resplit", preco_lib.preprocess, [data_home],
+                          inputs=resplit_inputs, outputs=resplit_outputs)
 
-  convert_format(data_home)
+  format_jobs = add_format_jobs(
+      graph, data_home, num_workers, binary, deps=[resplit_job])
   superset_dir = os.path.join(data_home, "processed", "preco/all_info")
   for subset in ["train", "dev", "test"]:
     all_info_filename = superset_dir + "/" + subset + ".jsonl"
-    for new_type in FN_MAP.keys():
-      for max_seg_len in [convert_lib.ProcessingStage.SEGMENTED_384,
-                          convert_lib.ProcessingStage.SEGMENTED_512]:
-        create_injected_file(all_info_filename, new_type, max_seg_len)
+    new_types = list(FN_MAP.keys())
+    for max_seg_len in [convert_lib.segmented_stage(max_segment_len)
+        for max_segment_len in convert_lib.DEFAULT_SEGMENT_LENS]:
+      # All inject types from one read of the segmented all_info file
+      graph.add(
+          "/".join(["preco/inject", "+".join(new_types), subset, max_seg_len]),
+          create_injected_files,
+          [all_info_filename, new_types, max_seg_len, binary],
+          deps=[format_jobs[subset]],
+          inputs=[segmented_file_name(all_info_filename, max_seg_len)],
+          outputs=injected_file_names(
+              all_info_filename, new_types, max_seg_len, binary),
+          params={"binary": binary})
+
 
+def convert(data_home, num_workers=1, binary=False, cache=None, num_jobs=1):
+  graph = schedule_lib.JobGraph()
+  add_jobs(graph, data_home, num_workers, binary)
+  graph.run(num_jobs, cache)
@@ -1,15 +1,40 @@
 """Resplit preco to make a test set."""
 
+import array
 import json
 import sys
 import os
 import random
+import shutil
 
 import convert_lib
 
-def get_records_from_preco_file(filename):
-  with open(filename, 'r') as f:
-    return f.readlines()
+def resplit_file_names(data_dir):
+  """(inputs, outputs) of preprocess."""
+  preco_orig_dir = os.path.join(data_dir, "original", "PreCo_1.0")
+  preco_dir = os.path.join(data_dir, "original", "preco")
+  return ([os.path.join(preco_orig_dir, split + ".jsonl")
+           for split in ["train", "dev"]],
+          [os.path.join(preco_dir, split + ".jsonl")
+           for split in convert_lib.DatasetSplit.ALL])
+
+
+def get_line_offsets(filename):
+  """Byte offset of the start of every line, followed by the file size."""
+  offsets = array.array('q', [0])
+  with open(filename, 'rb') as f:
+    for line in f:
+      offsets.append(offsets[-1] + len(line))
+  return offsets
+
+
+def copy_lines(filename, offsets, line_indices, output_filename):
+  """Copy the given lines, in the given order, as raw bytes."""
+  with open(filename, 'rb') as f:
+    with open(output_filename, 'wb') as out:
+      for i in line_indices:
+        f.seek(offsets[i])
+        out.write(f.read(offsets[i + 1] - offsets[i]))
 
 
 def preprocess(data_dir):
@@ -19,25 +44,22 @@ def preprocess(data_dir):
   
   convert_lib.create_dir(preco_dir)
 
-  resplit_datasets = {}
+  # Original dev becomes the test set as is
+  shutil.copyfile(os.path.join(preco_orig_dir, "dev.jsonl"),
+                  os.path.join(preco_dir, convert_lib.DatasetSplit.test + ".jsonl"))
 
-  resplit_datasets[
-      convert_lib.DatasetSplit.test] = get_records_from_preco_file(
-      os.path.join(preco_orig_dir, "dev.jsonl"))
-
-  temp_original_train = get_records_from_preco_file(
-      os.path.join(preco_orig_dir, "train.jsonl"))
+  # Only line offsets are kept in memory. Shuffling the line indices with the
+  # same seed gives the same permutation as shuffling the lines themselves.
+  train_filename = os.path.join(preco_orig_dir, "train.jsonl")
+  offsets = get_line_offsets(train_filename)
+  total_train = len(offsets) - 1
+  line_indices = list(range(total_train))
   random.seed(43)
-  random.shuffle(temp_original_train)
-  total_train = len(temp_original_train)
+  random.shuffle(line_indices)
   boundary = int(0.8 * total_train)
-  resplit_datasets[
-      convert_lib.DatasetSplit.train] = temp_original_train[:boundary]
-  resplit_datasets[
-      convert_lib.DatasetSplit.dev] = temp_original_train[boundary:]
-
-  for split_name, records in resplit_datasets.items():
+  for split_name, split_indices in [
+      (convert_lib.DatasetSplit.train, line_indices[:boundary]),
+      (convert_lib.DatasetSplit.dev, line_indices[boundary:])]:
     # Write resplit
-    with open(os.path.join(preco_dir, split_name + ".jsonl"), 'w') as f:
-      f.write("".join(records))
- 
+    copy_lines(train_filename, offsets, split_indices,
+               os.path.join(preco_dir, split_name + ".jsonl"))
@@ -0,0 +1,140 @@
+"""Runs conversion stages as a dependency graph, optionally over a process pool.
+
+Each job is one build stage, e.g. a (dataset, variant, split) conversion. A job
+starts once every job it depends on has finished, so independent splits and
+variants run side by side while resplit -> format -> injection stay ordered.
+Jobs the build cache says are up to date are skipped without being submitted.
+"""
+
+import collections
+import concurrent.futures
+import time
+
+Job = collections.namedtuple(
+    "Job", ["name", "fn", "args", "deps", "inputs", "outputs", "params"])
+
+
+def _timed_call(fn, args):
+  start_time = time.time()
+  fn(*args)
+  return time.time() - start_time
+
+
+def _run_in_worker(fn, args, setup, setup_args, collect):
+  """A job in a pool worker: (wall time, what `collect` returned)."""
+  if setup is not None:
+    setup(*setup_args)
+  seconds = _timed_call(fn, args)
+  return seconds, (collect() if collect is not None else None)
+
+
+class JobGraph(object):
+  def __init__(self):
+    self.jobs = collections.OrderedDict()
+
+  def add(self, name, fn, args=(), deps=(), inputs=(), outputs=(),
+          params=None):
+    """Add a job running fn(*args); `deps` must already have been added.
+
+    `inputs`, `outputs` and `params` are what the build cache keys it on.
+    Returns `name`, so it can be passed on as another job's dependency.
+    """
+    assert name not in self.jobs
+    assert all(dep in self.jobs for dep in deps)
+    self.jobs[name] = Job(name, fn, tuple(args), tuple(deps), list(inputs),
+                          list(outputs), params or {})
+    return name
+
+  def run(self, num_jobs=1, cache=None, setup=None, setup_args=(),
+          collect=None, merge=None):
+    """Run every job, at most `num_jobs` at a time.
+
+    With one job at a time, jobs run in this process in the order they were
+    added. Otherwise they run in a process pool; its workers are not daemonic,
+    so a job may start its own pool (e.g. convert_lib's document workers).
+
+    In the pool, `setup(*setup_args)` is called before each job to set up
+    per-process state such as the tokenizer; it should be cheap to repeat.
+    (ProcessPoolExecutor only takes an initializer from Python 3.7.) State a
+    job builds up (e.g. the token cache) is lost with its worker. If given,
+    `collect` is called in the worker after each job, and its result passed
+    to `merge` in this process. All three must be module-level functions.
+
+    Returns an OrderedDict from job name to wall time in seconds, or None for
+    jobs skipped by the cache.
+    """
+    runner = _JobRunner(self, cache, setup, setup_args, collect, merge)
+    if num_jobs <= 1:
+      for job in self.jobs.values():
+        if not runner.skip_if_fresh(job):
+          runner.finish(job, _timed_call(job.fn, job.args))
+    else:
+      with concurrent.futures.ProcessPoolExecutor(num_jobs) as executor:
+        runner.run_parallel(executor)
+    runner.report()
+    return runner.seconds
+
+
+class _JobRunner(object):
+  def __init__(self, graph, cache, setup=None, setup_args=(), collect=None,
+               merge=None):
+    self.graph = graph
+    self.cache = cache
+    self.setup = setup
+    self.setup_args = tuple(setup_args)
+    self.collect = collect
+    self.merge = merge
+    self.keys = {}
+    self.seconds = collections.OrderedDict()
+
+  def skip_if_fresh(self, job):
+    if self.cache is None:
+      return False
+    # Keyed only now, once the job's inputs have been written by its deps
+    key = self.cache.stage_key(job.name, job.inputs, job.params)
+    if self.cache.is_fresh(job.name, key, job.outputs):
+      print("Skipping unchanged stage {}".format(job.name))
+      self.seconds[job.name] = None
+      return True
+    self.keys[job.name] = key
+    return False
+
+  def finish(self, job, seconds):
+    print("Finished {} in {:.2f}s".format(job.name, seconds))
+    self.seconds[job.name] = seconds
+    if self.cache is not None:
+      self.cache.record(job.name, self.keys[job.name], job.outputs, seconds)
+
+  def submit(self, executor, job):
+    return executor.submit(_run_in_worker, job.fn, job.args, self.setup,
+                           self.setup_args, self.collect)
+
+  def run_parallel(self, executor):
+    waiting = list(self.graph.jobs.values())
+    running = {}
+    while waiting or running:
+      still_waiting = []
+      for job in waiting:
+        if not all(dep in self.seconds for dep in job.deps):
+          still_waiting.append(job)
+        elif not self.skip_if_fresh(job):
+          running[self.submit(executor, job)] = job
+      waiting = still_waiting
+      if not running:
+        # Only cached jobs became ready; look again for newly ready jobs
+        continue
+      done, _ = concurrent.futures.wait(
+          running, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        seconds, collected = future.result()
+        if self.collect is not None:
+          self.merge(collected)
+        self.finish(running.pop(future), seconds)
+
+  def report(self):
+    ran = [(name, seconds) for name, seconds in self.seconds.items()
+           if seconds is not None]
+    if ran:
+      print("Stage wall times:")
+      for name, seconds in ran:
+        print("  {}\t{:.2f}s".format(name, seconds))
@@ -0,0 +1,34 @@
+"""Mentions as arrays: an (n, 2) span array plus a cluster id per span.
+
+Spans are ordered by cluster, and within a cluster kept in their original
+order. Injected mentions come last, under the id num_clusters, so cluster
+ids never decrease and each cluster is one contiguous slice of the spans.
+"""
+
+import numpy as np
+
+INDEX_DTYPE = np.dtype("<i4")
+
+
+def span_array(spans):
+  return np.asarray(spans, dtype=INDEX_DTYPE).reshape(-1, 2)
+
+
+def encode_mentions(clusters, injected_mentions=()):
+  """(spans, cluster_ids) for clusters of [start, end] spans."""
+  injected_mentions = list(injected_mentions)
+  group_lens = [len(cluster) for cluster in clusters]
+  group_lens.append(len(injected_mentions))
+  spans = span_array(
+      [span for cluster in clusters for span in cluster] + injected_mentions)
+  cluster_ids = np.repeat(
+      np.arange(len(group_lens), dtype=INDEX_DTYPE), group_lens)
+  return spans, cluster_ids
+
+
+def decode_mentions(spans, cluster_ids, num_clusters):
+  """(clusters, injected_mentions) as nested lists, undoing encode_mentions."""
+  bounds = np.searchsorted(cluster_ids, np.arange(num_clusters + 2)).tolist()
+  flat_spans = spans.tolist()
+  groups = [flat_spans[start:end] for start, end in zip(bounds, bounds[1:])]
+  return groups[:-1], groups[-1]
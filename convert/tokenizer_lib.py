@@ -0,0 +1,177 @@
+"""Lazily loaded, memoizing wrapper around the WordPiece tokenizer."""
+
+import collections
+import json
+import os
+import time
+
+import build_cache
+
+DEFAULT_VOCAB_FILE = "/mnt/nfs/scratch1/nnayak/mention_bottleneck/convert/cased_config_vocab/vocab.txt"
+VOCAB_FILE_ENV = "MENTION_BOTTLENECK_VOCAB" # Overrides the default vocab path
+DEFAULT_CACHE_SIZE = 1 << 20 # Distinct tokens, comfortably covers CoNLL + PreCo
+
+
+class LazyTokenizer(object):
+  """Stands in for bert's FullTokenizer, building it on first use.
+
+  Importing bert pulls in TensorFlow, so nothing is loaded until a token is
+  actually tokenized. The tokenizer is then kept for the life of the process.
+  """
+  def __init__(self, vocab_file=None, do_lower_case=False):
+    self._vocab_file = vocab_file
+    self.do_lower_case = do_lower_case
+    self.load_time = None
+    self._tokenizer = None
+
+  @property
+  def vocab_file(self):
+    return (self._vocab_file or os.environ.get(VOCAB_FILE_ENV)
+            or DEFAULT_VOCAB_FILE)
+
+  def configure(self, vocab_file=None, do_lower_case=None):
+    if vocab_file is not None and vocab_file != self._vocab_file:
+      self._vocab_file = vocab_file
+      self._tokenizer = None
+    if do_lower_case is not None and do_lower_case != self.do_lower_case:
+      self.do_lower_case = do_lower_case
+      self._tokenizer = None
+
+  def get(self):
+    if self._tokenizer is None:
+      start_time = time.time()
+      from bert import tokenization
+      self._tokenizer = tokenization.FullTokenizer(
+          vocab_file=self.vocab_file, do_lower_case=self.do_lower_case)
+      self.load_time = time.time() - start_time
+      print("Loaded tokenizer from {} in {:.2f}s".format(
+          self.vocab_file, self.load_time))
+    return self._tokenizer
+
+  def tokenize(self, token):
+    return self.get().tokenize(token)
+
+  def convert_tokens_to_ids(self, tokens):
+    return self.get().convert_tokens_to_ids(tokens)
+
+
+class SubwordCache(object):
+  """Bounded LRU cache from token to its list of subwords.
+
+  Exposes the same `tokenize` method as the BERT tokenizer so it can be passed
+  anywhere a tokenizer is expected. Returned lists are shared between calls and
+  must not be mutated by the caller.
+
+  Caches in worker processes hand what they learned back to the parent's
+  cache with drain_updates / merge_updates.
+  """
+  def __init__(self, tokenizer, max_size=DEFAULT_CACHE_SIZE, vocab_file=None):
+    self.tokenizer = tokenizer
+    self.max_size = max_size
+    self._vocab_file = vocab_file
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._new_tokens = []
+    self._drained_counts = (0, 0, 0)
+
+  def tokenize(self, token):
+    subwords = self.entries.get(token)
+    if subwords is not None:
+      self.hits += 1
+      self.entries.move_to_end(token)
+      return subwords
+
+    self.misses += 1
+    subwords = self.tokenizer.tokenize(token)
+    self._add(token, subwords)
+    self._new_tokens.append(token)
+    return subwords
+
+  def _add(self, token, subwords):
+    self.entries[token] = subwords
+    if len(self.entries) > self.max_size:
+      self.entries.popitem(last=False) # Least recently used
+      self.evictions += 1
+
+  def _counts(self):
+    return (self.hits, self.misses, self.evictions)
+
+  def drain_updates(self):
+    """New entries and counter increments since the last drain.
+
+    Entries already evicted again are skipped. Pass the result to
+    merge_updates of the cache in another process.
+    """
+    entries = [(token, self.entries[token]) for token in self._new_tokens
+               if token in self.entries]
+    counts = [now - before for now, before
+              in zip(self._counts(), self._drained_counts)]
+    self._new_tokens = []
+    self._drained_counts = self._counts()
+    return {"entries": entries, "counts": counts}
+
+  def merge_updates(self, updates):
+    """Add entries and counters drained from another process's cache.
+
+    Merged entries count as new here too, so they can be drained onwards.
+    """
+    for token, subwords in updates["entries"]:
+      if token not in self.entries:
+        self._add(token, subwords)
+        self._new_tokens.append(token)
+    hits, misses, evictions = updates["counts"]
+    self.hits += hits
+    self.misses += misses
+    self.evictions += evictions
+
+  def convert_tokens_to_ids(self, tokens):
+    return self.tokenizer.convert_tokens_to_ids(tokens)
+
+  @property
+  def vocab_file(self):
+    return self._vocab_file or getattr(self.tokenizer, "vocab_file", None)
+
+  @property
+  def do_lower_case(self):
+    return getattr(self.tokenizer, "do_lower_case", None)
+
+  def cache_key(self):
+    """What the subword splits depend on: vocab contents and casing.
+
+    A missing vocab file can't be hashed, so its path stands in for it.
+    """
+    vocab_file = self.vocab_file
+    vocab_hash = (build_cache.hash_file(vocab_file)
+                  if vocab_file is not None and os.path.exists(vocab_file)
+                  else vocab_file)
+    return {"vocab_hash": vocab_hash, "do_lower_case": self.do_lower_case}
+
+  def stats(self):
+    return {"size": len(self.entries), "hits": self.hits,
+            "misses": self.misses, "evictions": self.evictions}
+
+  def load(self, cache_file):
+    """Warm the cache from disk.
+
+    Entries built from different vocab contents or casing are ignored.
+    """
+    if not os.path.exists(cache_file):
+      return False
+    with open(cache_file, 'r') as f:
+      saved = json.load(f)
+    if saved.get("key") != self.cache_key():
+      print("Ignoring token cache {} built with vocab {}".format(
+          cache_file, saved.get("vocab_file")))
+      return False
+    for token, subwords in saved["entries"][-self.max_size:]:
+      self.entries[token] = subwords
+    return True
+
+  def save(self, cache_file):
+    temp_file = cache_file + ".tmp"
+    with open(temp_file, 'w') as f:
+      json.dump({"vocab_file": self.vocab_file, "key": self.cache_key(),
+                 "entries": list(self.entries.items())}, f)
+    os.replace(temp_file, cache_file) # Never leave a half-written cache behind